@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Micro benchmarks for the internals of sharebox.
+
+Usage:
+
+bench.py [benchmark...]
+
+Every benchmark builds a throwaway git directory in /tmp, runs without
+mounting anything, and prints one line per measure.
+
+Benchmarks:
+    ignored                     per call latency of ignored(), compared
+                                to one 'git ls-files' per call.
+    readers                     read throughput of ShareBox.read() with
+                                1 to 8 threads reading different files,
+                                from the page cache, then waiting 1ms
+                                for each block (a slow disk or network),
+                                then while another file is written and
+                                released (and committed) over and over.
+                                Each against every operation under a
+                                single lock, as before per path locks.
+                                From the page cache, the GIL lets only
+                                one thread at a time run python either
+                                way: only waiting readers scale.
+    datapath                    sequential read and write throughput
+                                through the FUSE class, with and without
+                                copies of the buffers of fuse (best of 4
+                                runs, each variant first in turn).
+    readdir                     'ls -l' and 'find -type f' of a directory
+                                of 50000 files and annexed links, with
+                                readdir returning names only or
+                                attributes too.
+    unlock                      latency of the first write to a large
+                                annexed file, with each way to unlock it
+                                the filesystem of /tmp supports.
+"""
+from __future__ import with_statement
+
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from ctypes import POINTER, c_byte, cast, create_string_buffer, pointer
+
+import fuse
+import sharebox
+
+def report(name, seconds, calls):
+    print '%-40s %10.1f us/call' % (name, seconds * 1e6 / calls)
+
+def report_throughput(name, seconds, size):
+    print '%-40s %10.1f MB/s' % (name, size / seconds / 2**20)
+
+def make_gitdir(numfiles):
+    """
+    creates a git directory holding numfiles tracked files spread over a
+    few subdirectories, plus a .gitignore, and chdirs into it
+    """
+    gitdir = tempfile.mkdtemp(prefix='sharebox-bench-')
+    os.chdir(gitdir)
+    subprocess.call(['git', 'init', '-q'])
+    with open('.gitignore', 'w') as f:
+        f.write('*.o\nbuild/\n!keep.o\n')
+    for i in range(numfiles):
+        dirname = 'dir%d' % (i % 10)
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+        with open(os.path.join(dirname, 'file%d' % i), 'w') as f:
+            f.write(str(i))
+    subprocess.call(['git', 'add', '.'])
+    return gitdir
+
+def ls_files_ignored(path):
+    """
+    the implementation of ignored() before the in process matcher
+    """
+    path_ = path[2:]
+    ls_options = "-c -o -d -m --full-name --exclude-standard"
+    considered = subprocess.Popen(
+            shlex.split('git ls-files %s -- "%s"' % (ls_options, path_)),
+            stdout=subprocess.PIPE).communicate()[0].strip().split('\n')
+    return path_ not in considered
+
+def bench_ignored():
+    gitdir = make_gitdir(2000)
+    try:
+        paths = ['./dir%d/file%d' % (i % 10, i) for i in range(0, 2000, 10)]
+        paths += ['./dir1/new.o', './dir2/untracked', './build/x']
+        for name, func in (('ignored (git ls-files)', ls_files_ignored),
+                ('ignored (in process)', sharebox.ignored)):
+            start = time.time()
+            for path in paths:
+                func(path)
+            report(name, time.time() - start, len(paths))
+    finally:
+        os.chdir('/')
+        shutil.rmtree(gitdir)
+
+def bench_readers():
+    gitdir = make_gitdir(0)
+    try:
+        sb = sharebox.ShareBox(gitdir, '/nonexistent', 0, False, 'true')
+        # what sharebox did before per path locks: every operation under
+        # a single lock
+        biglock = threading.Lock()
+        def serialized(op, *args):
+            with biglock:
+                return sb(op, *args)
+        block = 128 * 1024
+        filesize = 8 * 1024 * 1024
+        for i in range(8):
+            with open('reader%d' % i, 'w') as f:
+                f.write('x' * filesize)
+        handles = [sb('open', '/reader%d' % i, os.O_RDONLY)
+                for i in range(8)]
+        pread = sharebox.pread
+        def slow_pread(fd, buf, size, offset):
+            # a disk seek or a network round trip, without the GIL
+            time.sleep(0.001)
+            return pread(fd, buf, size, offset)
+        def reader(call, i, deadline, done):
+            path = '/reader%d' % i
+            offset = total = 0
+            while time.time() < deadline:
+                total += len(call('read', path, block, offset, handles[i]))
+                offset = (offset + block) % filesize
+            done.append(total)
+        def writer(call, deadline, done):
+            # a release that commits (commitdelay is 0) on its own path
+            data = 'y' * filesize
+            while time.time() < deadline:
+                fh = call('create', '/written', 0644)
+                call('write', '/written', data, 0, fh)
+                start = time.time()
+                call('release', '/written', fh)
+                done.append(time.time() - start)
+        def run(name, call, numthreads, commits=False):
+            done, released = [], []
+            deadline = time.time() + 2
+            threads = [threading.Thread(target=reader,
+                args=(call, i, deadline, done)) for i in range(numthreads)]
+            if commits:
+                threads.append(threading.Thread(target=writer,
+                    args=(call, deadline, released)))
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            report_throughput(name, time.time() - start, sum(done))
+            if released:
+                report('  release and commit', sum(released), len(released))
+        locking = (('path locks', sb), ('one lock', serialized))
+        for numthreads in (1, 2, 4, 8):
+            for name, call in locking:
+                run('readers (%d threads, %s)' % (numthreads, name), call,
+                        numthreads)
+        sharebox.pread = slow_pread
+        try:
+            for numthreads in (1, 2, 4, 8):
+                for name, call in locking:
+                    run('slow readers (%d threads, %s)' % (numthreads,
+                        name), call, numthreads)
+        finally:
+            sharebox.pread = pread
+        for name, call in locking:
+            run('readers (4 threads, commits, %s)' % name, call, 4,
+                    commits=True)
+        for i in range(8):
+            sb('release', '/reader%d' % i, handles[i])
+    finally:
+        os.chdir('/')
+        shutil.rmtree(gitdir)
+
+def bench_datapath():
+    gitdir = make_gitdir(0)
+    try:
+        sb = sharebox.ShareBox(gitdir, '/nonexistent', 0, False, 'true')
+        # the FUSE methods called by libfuse, without mounting anything
+        # nor logging
+        mount = fuse.FUSE.__new__(fuse.FUSE)
+        mount.operations = lambda op, path, *args: getattr(sb, op)(
+                '.' + path, *args)
+        mount.raw_fi = False
+        block = 128 * 1024
+        filesize = 256 * 1024 * 1024
+        buf = create_string_buffer('x' * block, block)
+        bufp = cast(buf, POINTER(c_byte))
+        fi = fuse.fuse_file_info()
+        def write(path):
+            fi.fh = sb('create', path, 0644)
+            start = time.time()
+            for offset in xrange(0, filesize, block):
+                mount.write(path, bufp, block, offset, pointer(fi))
+            elapsed = time.time() - start
+            sb('release', path, fi.fh)
+            return elapsed
+        def read(path):
+            fi.fh = sb('open', path, os.O_RDONLY)
+            start = time.time()
+            for offset in xrange(0, filesize, block):
+                mount.read(path, bufp, block, offset, pointer(fi))
+            elapsed = time.time() - start
+            sb('release', path, fi.fh)
+            return elapsed
+        # every run on a file and a handle of its own, the variants in
+        # turn first: what the first writer of a file pays (hashing it
+        # as it goes, see WriteHashes) or the first reader (the page
+        # cache) is the same for all of them
+        runs = 4
+        writes = (('copying', False), ('memoryview', True))
+        times = dict((name, []) for name, flag in writes)
+        for run in range(runs):
+            order = writes if run % 2 == 0 else writes[::-1]
+            for name, write_memoryview in order:
+                mount.write_memoryview = write_memoryview
+                path = '/big-%s-%d' % (name, run)
+                times[name].append(write(path))
+                sb('unlink', path)
+        for name, write_memoryview in writes:
+            report_throughput('write (%s)' % name, min(times[name]),
+                    filesize)
+        mount.write_memoryview = mount.use_readinto = True
+        write('/big')
+        read('/big')
+        reads = (('copying', False), ('readinto', True))
+        times = dict((name, []) for name, flag in reads)
+        for run in range(runs):
+            order = reads if run % 2 == 0 else reads[::-1]
+            for name, use_readinto in order:
+                mount.use_readinto = use_readinto
+                times[name].append(read('/big'))
+        for name, use_readinto in reads:
+            report_throughput('read (%s)' % name, min(times[name]),
+                    filesize)
+    finally:
+        os.chdir('/')
+        shutil.rmtree(gitdir)
+
+def bench_readdir():
+    gitdir = make_gitdir(0)
+    try:
+        sb = sharebox.ShareBox(gitdir, '/nonexistent', 0, False, 'true')
+        key = 'SHA256E-s4--bench'
+        target = '.git/annex/objects/Xx/Yy/%s/%s' % (key, key)
+        os.makedirs(os.path.dirname(target))
+        with open(target, 'w') as f:
+            f.write('data')
+        os.mkdir('big')
+        for i in xrange(25000):
+            with open('big/file%d' % i, 'w') as f:
+                f.write('x')
+            os.symlink('../' + target, 'big/link%d' % i)
+        def names_only(path, fh):
+            return ['.', '..'] + os.listdir(path)
+        # the FUSE methods called by libfuse, without mounting anything
+        # nor logging
+        mount = fuse.FUSE.__new__(fuse.FUSE)
+        mount.raw_fi = False
+        fi = fuse.fuse_file_info()
+        st = fuse.c_stat()
+        def ls_l(buf, name, stp, offset):
+            if name not in ('.', '..'):
+                mount.getattr('/big/' + name, pointer(st))
+            return 0
+        def find_type_f(buf, name, stp, offset):
+            # entries that come with attributes come with their type: find
+            # doesn't need to stat them
+            if stp is None and name not in ('.', '..'):
+                mount.getattr('/big/' + name, pointer(st))
+            return 0
+        for filler, walkname in ((ls_l, 'ls -l'),
+                (find_type_f, 'find -type f')):
+            for readdir, readdirname in ((names_only, 'names'),
+                    (sb.readdir, 'attributes')):
+                def operations(op, path, *args):
+                    if op == 'readdir':
+                        return readdir('.' + path, *args)
+                    return getattr(sb, op)('.' + path, *args)
+                mount.operations = operations
+                sb.metadata.clear()
+                start = time.time()
+                mount.readdir('/big', None, filler, 0, pointer(fi))
+                print '%-40s %10.1f ms' % ('%s, 50000 entries (%s)'
+                        % (walkname, readdirname), (time.time() - start) * 1e3)
+    finally:
+        os.chdir('/')
+        shutil.rmtree(gitdir)
+
+def bench_unlock():
+    gitdir = make_gitdir(0)
+    try:
+        sb = sharebox.ShareBox(gitdir, '/nonexistent', 0, False, 'true')
+        size = 1024 * 1024 * 1024
+        key = 'SHA256E-s%d--bench' % size
+        target = '.git/annex/objects/Xx/Yy/%s/%s' % (key, key)
+        os.makedirs(os.path.dirname(target))
+        with open(target, 'w') as f:
+            for i in xrange(size / 2**20):
+                f.write('x' * 2**20)
+        os.chmod(target, 0444)
+        dev = os.stat('.git/sharebox').st_dev
+        for method in sharebox.unlock_methods:
+            src = os.open(target, os.O_RDONLY)
+            dst, tmp = tempfile.mkstemp(dir='.git/sharebox')
+            try:
+                sharebox.clone_file(src, dst, method)
+                supported = True
+            except EnvironmentError:
+                supported = False
+            finally:
+                os.close(src)
+                os.close(dst)
+                os.remove(tmp)
+            name = 'first write, 1GiB (%s)' % method
+            if not supported:
+                print '%-40s %10s' % (name, 'unsupported')
+                continue
+            sharebox._unlock_methods[dev] = method
+            os.symlink(target, 'big')
+            fh = sb('open', '/big', os.O_WRONLY)
+            start = time.time()
+            sb('write', '/big', 'y', 0, fh)
+            print '%-40s %10.1f ms' % (name,
+                    (time.time() - start) * 1e3)
+            # drop the copy instead of committing it
+            os.close(sb.handles.pop(fh).copy)
+            sb.commits.writers.pop(fh, None)
+            os.close(fh)
+            os.remove('big')
+            sb.metadata.invalidate('./big')
+    finally:
+        os.chdir('/')
+        shutil.rmtree(gitdir)
+
+benchmarks = {
+        'ignored': bench_ignored,
+        'readers': bench_readers,
+        'datapath': bench_datapath,
+        'readdir': bench_readdir,
+        'unlock': bench_unlock,
+        }
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or sorted(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            print 'unknown benchmark: %s' % name
+            print __doc__
+            sys.exit(1)
+    for name in names:
+        benchmarks[name]()
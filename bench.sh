@@ -0,0 +1,187 @@
+#!/usr/bin/env sh
+
+# benchmark suite for sharebox: mounts local replicas and times a fixed
+# set of workloads through them.
+#
+# Every measure is printed as a JSON line:
+#   {"bench": ..., "metric": ..., "value": ..., "unit": ..., "revision": ...}
+# so that the output of two revisions can be compared line by line.
+#
+# The size of the workloads can be changed through the environment:
+#   BENCH_SIZE_MB       size of the large file (default 256)
+#   BENCH_RANDOM_READS  number of random 4K reads (default 2000)
+#   BENCH_FILES         number of small files (default 10000)
+#   BENCH_RENAMES       number of renames (default 1000)
+#   BENCH_SYNC_FILES    number of files changed before a sync (default 100)
+#   BENCH_OPTS          extra mount options, e.g. "-o commitdelay=1"
+
+size_mb=${BENCH_SIZE_MB:-256}
+random_reads=${BENCH_RANDOM_READS:-2000}
+files=${BENCH_FILES:-10000}
+renames=${BENCH_RENAMES:-1000}
+sync_files=${BENCH_SYNC_FILES:-100}
+revision=$(git rev-parse --short HEAD 2>/dev/null)$(git diff --quiet \
+    HEAD -- sharebox.py fuse.py 2>/dev/null || echo "-dirty")
+
+#-----------------------------------------------------------------------#
+# base commands
+#-----------------------------------------------------------------------#
+
+init(){
+    mkdir -p test/$1/mnt test/$1/git
+    (cd test/$1/git && git init && git annex init $1 && cd -) >/dev/null
+}
+
+mount(){
+    ./sharebox.py test/$1/mnt -o gitdir=test/$1/git $BENCH_OPTS
+}
+
+unmount(){
+    fusermount -u -z test/$1/mnt >/dev/null
+}
+
+clean(){
+    chmod -R +w test
+    rm -rf test
+}
+
+remote_add(){
+    (cd test/$1/git && git remote add $2 ../../$2/git && cd -) >/dev/null
+}
+
+make_peers(){
+    remote_add $1 $2
+    remote_add $2 $1
+}
+
+now(){
+    date +%s.%N
+}
+
+# result bench metric value unit
+result(){
+    printf '{"bench": "%s", "metric": "%s", "value": %s, "unit": "%s", ' \
+        "$1" "$2" "$3" "$4"
+    printf '"revision": "%s"}\n' "$revision"
+}
+
+# seconds start end
+seconds(){
+    awk "BEGIN { printf \"%.6f\", $2 - $1 }"
+}
+
+# rate count start end
+rate(){
+    awk "BEGIN { printf \"%.2f\", $1 / ($3 - $2) }"
+}
+
+#-----------------------------------------------------------------------#
+# workloads
+#-----------------------------------------------------------------------#
+
+sequential(){
+    init local
+    mount local
+    start=$(now)
+    dd if=/dev/zero of=test/local/mnt/big bs=1M count=$size_mb \
+        conv=fsync 2>/dev/null
+    end=$(now)
+    result sequential_write throughput $(rate $size_mb $start $end) MB/s
+    # mount again, so that nothing is read from the page cache
+    unmount local
+    mount local
+    start=$(now)
+    dd if=test/local/mnt/big of=/dev/null bs=1M 2>/dev/null
+    end=$(now)
+    result sequential_read throughput $(rate $size_mb $start $end) MB/s
+    python - test/local/mnt/big $random_reads <<'EOF'
+import os, random, sys, time
+path, count = sys.argv[1], int(sys.argv[2])
+fd = os.open(path, os.O_RDONLY)
+blocks = os.fstat(fd).st_size // 4096
+random.seed(0)
+latencies = []
+for i in range(count):
+    start = time.time()
+    os.lseek(fd, random.randrange(blocks) * 4096, 0)
+    os.read(fd, 4096)
+    latencies.append(time.time() - start)
+os.close(fd)
+latencies.sort()
+line = ('{"bench": "random_read_4k", "metric": "%s", "value": %s, '
+        '"unit": "%s", "revision": "' + os.environ['revision'] + '"}')
+print(line % ('throughput', '%.2f' % (count / sum(latencies)), 'ops/s'))
+print(line % ('p50', '%.6f' % latencies[count // 2], 's'))
+print(line % ('p99', '%.6f' % latencies[count * 99 // 100], 's'))
+EOF
+    unmount local
+    clean
+}
+
+small_files(){
+    init local
+    mount local
+    mkdir test/local/mnt/tree
+    start=$(now)
+    python - test/local/mnt/tree $files <<'EOF'
+import os, sys
+root, count = sys.argv[1], int(sys.argv[2])
+for i in range(count):
+    directory = os.path.join(root, 'dir%d' % (i % 100))
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    with open(os.path.join(directory, 'file%d' % i), 'w') as f:
+        f.write('%d\n' % i)
+EOF
+    end=$(now)
+    result create_small_files throughput $(rate $files $start $end) files/s
+    # the tree, once written, is walked from a fresh mount
+    unmount local
+    mount local
+    start=$(now)
+    ls -lR test/local/mnt/tree >/dev/null
+    end=$(now)
+    result ls_l_tree seconds $(seconds $start $end) s
+    start=$(now)
+    find test/local/mnt/tree -type f >/dev/null
+    end=$(now)
+    result find_tree seconds $(seconds $start $end) s
+    start=$(now)
+    python - test/local/mnt/tree $renames <<'EOF'
+import os, sys
+root, count = sys.argv[1], int(sys.argv[2])
+for i in range(count):
+    # back and forth between two directories
+    os.rename(os.path.join(root, 'dir%d' % (i % 100), 'file%d' % i),
+              os.path.join(root, 'dir%d' % ((i + 1) % 100), 'moved%d' % i))
+EOF
+    end=$(now)
+    result rename_storm throughput $(rate $renames $start $end) renames/s
+    unmount local
+    clean
+}
+
+sync_changes(){
+    init local
+    init remote
+    mount local
+    mount remote
+    make_peers local remote
+    i=0
+    while test $i -lt $sync_files; do
+        echo "change $i" > test/local/mnt/file$i
+        i=$((i + 1))
+    done
+    start=$(now)
+    ./sharebox.py -c sync test/remote/mnt
+    end=$(now)
+    result sync_changed_files seconds $(seconds $start $end) s
+    unmount local
+    unmount remote
+    clean
+}
+
+export revision
+sequential
+small_files
+sync_changes
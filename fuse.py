@@ -180,6 +180,21 @@ class fuse_context(Structure):
         ('pid', c_pid_t),
         ('private_data', c_voidp)]
 
+class fuse_conn_info(Structure):
+    _fields_ = [
+        ('proto_major', c_uint),
+        ('proto_minor', c_uint),
+        ('async_read', c_uint),
+        ('max_write', c_uint),
+        ('max_readahead', c_uint),
+        ('capable', c_uint),
+        ('want', c_uint),
+        ('max_background', c_uint),
+        ('congestion_threshold', c_uint),
+        ('reserved', c_uint * 23)]
+
+FUSE_CAP_ATOMIC_O_TRUNC = 1 << 3
+
 class fuse_operations(Structure):
     _fields_ = [
         ('getattr', CFUNCTYPE(c_int, c_char_p, POINTER(c_stat))),
@@ -253,6 +268,47 @@ def fuse_get_context():
     return ctx.uid, ctx.gid, ctx.pid
 
 
+FUSE_ROOT_ID = 1
+
+# the channel to the kernel of the mounted filesystem, set by FUSE.init
+_channel = None
+
+try:
+    _libfuse.fuse_get_session.restype = c_voidp
+    _libfuse.fuse_get_session.argtypes = [c_voidp]
+    _libfuse.fuse_session_next_chan.restype = c_voidp
+    _libfuse.fuse_session_next_chan.argtypes = [c_voidp, c_voidp]
+    _libfuse.fuse_lowlevel_notify_inval_inode.argtypes = [c_voidp, c_ulong,
+        c_off_t, c_off_t]
+    _libfuse.fuse_lowlevel_notify_inval_entry.argtypes = [c_voidp, c_ulong,
+        c_char_p, c_size_t]
+    notify_supported = True
+except AttributeError:
+    notify_supported = False     # libfuse older than 2.8
+
+
+def notify_inval_inode(ino, offset=0, length=0):
+    """Makes the kernel forget the attributes of inode ino, and its cached
+       data from offset on (up to length bytes, 0 for all of it).
+       Returns 0 or a negative errno. Only FUSE_ROOT_ID is known for sure
+       with the high level API."""
+    if not notify_supported or _channel is None:
+        return -ENOSYS
+    return _libfuse.fuse_lowlevel_notify_inval_inode(_channel, ino, offset,
+        length)
+
+
+def notify_inval_entry(parent, name):
+    """Makes the kernel forget the entry name of the directory inode
+       parent, and with it the cached entries and attributes below it.
+       Returns 0 or a negative errno. Must not be called from an operation
+       on parent: the kernel locks it."""
+    if not notify_supported or _channel is None:
+        return -ENOSYS
+    return _libfuse.fuse_lowlevel_notify_inval_entry(_channel, parent, name,
+        len(name))
+
+
 class FuseOSError(OSError):
     def __init__(self, errno):
         super(FuseOSError, self).__init__(errno, strerror(errno))
@@ -270,6 +326,9 @@ class FUSE(object):
         
         self.operations = operations
         self.raw_fi = raw_fi
+        self.use_readinto = getattr(operations, 'readinto', None) is not None
+        self.write_memoryview = getattr(operations, 'write_memoryview', False)
+        self.atomic_o_trunc = getattr(operations, 'atomic_o_trunc', False)
         args = ['fuse']
         if kwargs.pop('foreground', False):
             args.append('-f')
@@ -359,15 +418,21 @@ class FUSE(object):
     
     def read(self, path, buf, size, offset, fip):
         fh = fip.contents if self.raw_fi else fip.contents.fh
+        if self.use_readinto:
+            return self.operations('readinto', path, buf, size, offset, fh)
         ret = self.operations('read', path, size, offset, fh)
         if not ret:
             return 0
-        data = create_string_buffer(ret[:size], size)
-        memmove(buf, data, size)
-        return size
+        retsize = min(len(ret), size)
+        memmove(buf, ret, retsize)
+        return retsize
     
     def write(self, path, buf, size, offset, fip):
-        data = string_at(buf, size)
+        if self.write_memoryview:
+            data = memoryview((c_char * size).from_address(addressof(
+                buf.contents)))
+        else:
+            data = string_at(buf, size)
         fh = fip.contents if self.raw_fi else fip.contents.fh
         return self.operations('write', path, data, offset, fh)
     
@@ -425,14 +490,20 @@ class FUSE(object):
     
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
+        # entries often share their attributes dict: convert each once
+        # (keeping it referenced, so that its id isn't reused)
+        converted = {}
         for item in self.operations('readdir', path, fip.contents.fh):
             if isinstance(item, str):
                 name, st, offset = item, None, 0
             else:
                 name, attrs, offset = item
                 if attrs:
-                    st = c_stat()
-                    set_st_attrs(st, attrs)
+                    st = converted.get(id(attrs), (None, None))[1]
+                    if st is None:
+                        st = c_stat()
+                        set_st_attrs(st, attrs)
+                        converted[id(attrs)] = (attrs, st)
                 else:
                     st = None
             if filler(buf, name, st, offset) != 0:
@@ -448,10 +519,24 @@ class FUSE(object):
         return self.operations('fsyncdir', path, datasync, fip.contents.fh)
     
     def init(self, conn):
+        global _channel
+        if conn and self.atomic_o_trunc:
+            # open gets O_TRUNC instead of a truncate before it
+            info = cast(conn, POINTER(fuse_conn_info)).contents
+            if info.capable & FUSE_CAP_ATOMIC_O_TRUNC:
+                info.want |= FUSE_CAP_ATOMIC_O_TRUNC
+        if notify_supported:
+            fuse = _libfuse.fuse_get_context().contents.fuse
+            _channel = _libfuse.fuse_session_next_chan(
+                _libfuse.fuse_get_session(fuse), None)
         return self.operations('init', '/')
     
     def destroy(self, private_data):
-        return self.operations('destroy', '/')
+        global _channel
+        try:
+            return self.operations('destroy', '/')
+        finally:
+            _channel = None
     
     def access(self, path, amode):
         return self.operations('access', path, amode)
@@ -587,6 +672,11 @@ class Operations(object):
         """Returns a string containing the data requested."""
         raise FuseOSError(EIO)
     
+    # When defined as readinto(self, path, buf, size, offset, fh), it is
+    # used instead of read: it should copy at most size bytes directly into
+    # buf (a ctypes pointer to the buffer of fuse) and return their number.
+    readinto = None
+    
     def readdir(self, path, fh):
         """Can return either a list of names, or a list of (name, attrs, offset)
            tuples. attrs is a dict as in getattr."""
@@ -634,6 +724,14 @@ class Operations(object):
     
     def write(self, path, data, offset, fh):
         raise FuseOSError(EROFS)
+    
+    # When True, write receives a memoryview over the buffer of fuse instead
+    # of a copy of it as a string. It is only valid until write returns.
+    write_memoryview = False
+    
+    # When True, open receives O_TRUNC and has to truncate the file itself,
+    # instead of being preceded by a truncate.
+    atomic_o_trunc = False
 
 
 class LoggingMixIn:
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Replays the operations recorded with 'sharebox -o trace=<file>' on a
+ShareBox, without mounting anything.
+
+Usage:
+
+replay.py [options] <trace>
+
+Options:
+    -g <gitdir>                 replay on this git directory (default: a
+                                throwaway one in /tmp, where the files the
+                                trace uses without creating them are
+                                created first).
+    -j <threads>                replay the operations of the recorded
+                                threads on this many threads (default 1).
+    -r                          wait between operations as long as
+                                recorded (default: as fast as possible).
+    -p <file>                   profile the replay with cProfile, save
+                                the stats in file and print the top
+                                functions.
+
+The stats of sharebox (see .stats) are printed at the end.
+"""
+from __future__ import with_statement
+
+import cProfile
+import getopt
+import json
+import os
+import pstats
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from ctypes import create_string_buffer
+from errno import ENOENT
+
+import sharebox
+
+# the operations that take a file handle as their last argument
+handle_ops = ('read', 'readinto', 'write', 'release', 'flush', 'fsync',
+        'readdir', 'releasedir', 'fsyncdir', 'getattr', 'truncate')
+
+def load(filename):
+    """
+    returns the recorded operations, with their paths and strings back
+    to bytes. init and destroy are left out: the replay does them.
+    """
+    records = []
+    with open(filename) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['op'] in ('init', 'destroy'):
+                continue
+            record['path'] = record['path'].encode('latin-1')
+            record['args'] = [arg.encode('latin-1')
+                    if isinstance(arg, unicode) else arg
+                    for arg in record['args']]
+            records.append(record)
+    return records
+
+def seed(records):
+    """
+    creates the files and directories the trace uses before creating
+    them, big enough for what is read from them
+    """
+    created = set()
+    sizes = {}
+    dirs = set()
+    for record in records:
+        op, path, args = record['op'], record['path'], record['args']
+        if op in ('create', 'mkdir', 'symlink'):
+            created.add(path)
+        if path in created or record['errno'] == ENOENT:
+            continue
+        if op in ('readdir', 'opendir'):
+            dirs.add(path)
+        elif op in ('read', 'readinto'):
+            size, offset = args[-3], args[-2]
+            sizes[path] = max(sizes.get(path, 0), offset + size)
+        elif op in ('open', 'getattr', 'truncate', 'rename', 'unlink'):
+            sizes.setdefault(path, 4096)
+    for path in sorted(dirs):
+        if not os.path.isdir('.' + path):
+            os.makedirs('.' + path)
+    for path, size in sizes.items():
+        if path in dirs or path.startswith('/.'):
+            continue
+        if not os.path.isdir(os.path.dirname('.' + path)):
+            os.makedirs(os.path.dirname('.' + path))
+        if not os.path.exists('.' + path):
+            with open('.' + path, 'w') as f:
+                f.truncate(size)
+
+def arguments(record, handles):
+    """
+    returns the arguments to replay record with, None if it uses a
+    handle that was not opened
+    """
+    op, args = record['op'], list(record['args'])
+    for i, arg in enumerate(args):
+        if isinstance(arg, dict) and 'bytes' in arg:
+            args[i] = memoryview('x' * arg['bytes'])
+        elif isinstance(arg, dict) and 'buffer' in arg:
+            args[i] = create_string_buffer(args[i + 1])
+    if op in handle_ops and args and isinstance(args[-1], (int, long)):
+        if op == 'truncate' and len(args) == 1:
+            return args
+        if args[-1] not in handles:
+            if op == 'readdir':
+                return args
+            return None
+        args[-1] = handles[args[-1]]
+    return args
+
+def replay(sb, records, numthreads, realtime, profile):
+    """
+    replays records on sb, the records of a recorded thread in their
+    order, on one of numthreads threads. Returns the number of skipped
+    records and the profiles of the threads.
+    """
+    queues = [[] for i in range(numthreads)]
+    threads_seen = {}
+    for record in records:
+        thread = threads_seen.setdefault(record['thread'], len(threads_seen))
+        queues[thread % numthreads].append(record)
+    handles = {}
+    skipped = []
+    profiles = []
+    start = time.time()
+    def worker(queue):
+        profiler = cProfile.Profile() if profile else None
+        if profiler:
+            profiler.enable()
+        for record in queue:
+            if realtime:
+                delay = start + record['time'] - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            args = arguments(record, handles)
+            if args is None:
+                skipped.append(record)
+                continue
+            try:
+                ret = sb(record['op'], record['path'], *args)
+            except EnvironmentError:
+                continue
+            if record['op'] in ('open', 'create', 'opendir'):
+                handles[record['ret']] = ret
+        if profiler:
+            profiler.disable()
+            profiles.append(profiler)
+    threads = [threading.Thread(target=worker, args=(queue,))
+            for queue in queues]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(skipped), profiles
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hg:j:rp:")
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__
+        sys.exit(1)
+    gitdir = None
+    numthreads = 1
+    realtime = False
+    profile = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print __doc__
+            sys.exit(0)
+        elif opt == '-g':
+            gitdir = os.path.realpath(arg)
+        elif opt == '-j':
+            numthreads = int(arg)
+        elif opt == '-r':
+            realtime = True
+        elif opt == '-p':
+            profile = arg
+    if len(args) != 1:
+        print __doc__
+        sys.exit(1)
+
+    records = load(args[0])
+    throwaway = gitdir is None
+    if throwaway:
+        gitdir = tempfile.mkdtemp(prefix='sharebox-replay-')
+        os.chdir(gitdir)
+        subprocess.call(['git', 'init', '-q'])
+        seed(records)
+    try:
+        sb = sharebox.ShareBox(gitdir, '/nonexistent', 0, False, 'true')
+        sb('init', '/')
+        start = time.time()
+        skipped, profiles = replay(sb, records, numthreads, realtime,
+                profile)
+        elapsed = time.time() - start
+        sb('destroy', '/')
+        print '%d operations replayed in %.3f s on %d threads' % (
+                len(records) - skipped, elapsed, numthreads)
+        if skipped:
+            print '%d skipped: their handle was not opened' % skipped
+        print sharebox.stats.render()
+        if profiles:
+            merged = pstats.Stats(profiles[0])
+            for profiler in profiles[1:]:
+                merged.add(profiler)
+            merged.dump_stats(profile)
+            merged.sort_stats('cumulative').print_stats(25)
+    finally:
+        if throwaway:
+            os.chdir('/')
+            shutil.rmtree(gitdir)
@@ -12,13 +12,56 @@ Options:
                                 actually store the files in.
     -o numversions=<number>     number of different versions of the same
                                 file to keep. Any number <=0 means "keep
-                                everything" (default 0).
+                                everything" (default 0). The older ones
+                                are dropped in the background, when the
+                                filesystem is idle, if the remotes have
+                                enough copies of them.
     -o getall                   when there are modifications on a remote,
                                 download the content of files.
+    -o getalljobs=<number>      number of parallel downloads of getall
+                                (default 4).
+    -o getallorder=<order>      download the "largest" or the "smallest"
+                                files first with getall (default
+                                "largest").
     -o notifycmd                How the filesystem should notify you about
                                 problems: string containing "%s" between
                                 quotes (default:
                                 'notify-send "sharebox" "%s"').
+    -o commitdelay=<seconds>    group the commits of the changes made
+                                within this delay (default 0: commit
+                                every change as soon as it is made).
+    -o prefetch=<policy>        when a missing file is opened, also get
+                                in the background the missing files of
+                                its directory: all of them ("dir"), the
+                                ones with the same extension ("ext"), the
+                                most recently modified first ("recent"),
+                                or none (default "none").
+    -o prefetchjobs=<number>    number of parallel prefetches (default 2).
+    -o prefetchbudget=<MiB>     maximum size of the content being
+                                prefetched at any time (default 512).
+    -o sync=<seconds>           sync with the remotes that changed at this
+                                interval (default 0: only on command).
+    -o synctimeout=<seconds>    give up fetching a remote after this
+                                delay (default 300).
+    -o cachetimeout=<seconds>   how long the kernel may keep attributes,
+                                names and data without asking again
+                                (default 60). sharebox tells it to forget
+                                the paths changed by merges, commits and
+                                downloads. Changes made in the gitdir, not
+                                through the mountpoint, are seen after
+                                that delay.
+    -o loglevel=<level>         log as JSON lines the errors ("error"),
+                                the warnings too ("warning", the
+                                default), the commands run ("info"), or
+                                every operation ("debug", the default in
+                                foreground).
+    -o logsample=<number>       at the debug level, log only one
+                                operation out of this many (default 1).
+    -o logfile=<path>           where to log (default: the standard
+                                output, lost unless in foreground).
+    -o trace=<path>             record every operation in this file, for
+                                replay.py to replay them without
+                                mounting anything.
     -o foreground               debug mode.
 
 Commands:
@@ -30,23 +73,517 @@ Commands:
 """
 from __future__ import with_statement
 
-from errno import EACCES
+from errno import EACCES, EBADF, EINVAL, EIO, EISDIR, ENOENT, EROFS
 import threading
+from collections import OrderedDict, deque
+from ctypes import (CDLL, POINTER, byref, c_int, c_longlong, c_size_t,
+        c_ssize_t, c_uint, c_void_p, create_string_buffer, get_errno,
+        memmove)
+from ctypes.util import find_library
 
 import os
 import os.path
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
-
+from fuse import FUSE, FuseOSError, Operations
+from fuse import (FUSE_ROOT_ID, notify_inval_entry, notify_inval_inode,
+        notify_supported)
+
+import fcntl
+import hashlib
+import itertools
+import json
+import math
+import mmap
+import re
 import shlex
+import stat
 import subprocess
+import tempfile
 import time
 import sys
 import getopt
+import random
 import time
 
 foreground = False
 
+# handles of the virtual files, out of the range of file descriptors
+virtual_handles = itertools.count(1 << 32)
+
+class Histogram:
+    """
+    Distribution of durations, in buckets 2**(1/4) times wider than the
+    previous one, starting at 1us: percentiles are within 19%.
+    """
+    size = 128
+
+    def __init__(self):
+        self.buckets = [0] * self.size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        i = 0
+        if us >= 1:
+            i = min(int(math.log(us, 2) * 4) + 1, self.size - 1)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        returns the upper bound of the bucket holding the percentile p
+        (between 0 and 1), in seconds, at most the maximum
+        """
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(list(self.buckets)):
+            seen += n
+            if n and seen >= rank:
+                return min(2 ** (i / 4.0) / 1e6, self.max)
+        return 0.0
+
+class Stats:
+    """
+    Performance counters of the whole filesystem
+
+    Recording is a few dictionary and list operations under the GIL,
+    without locks: two threads updating the same counter at the same time
+    may rarely lose one update. Rendering only reads.
+
+    usage:
+
+    >>>  stats.time('op getattr', seconds)
+    >>>  stats.count('bytes read', n)
+    >>>  stats.set('sync origin seconds', seconds)
+    >>>  stats.render()
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.values = {}
+
+    def time(self, name, seconds):
+        histogram = self.timings.get(name)
+        if histogram is None:
+            histogram = self.timings.setdefault(name, Histogram())
+        histogram.add(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def render(self):
+        """
+        returns the stats as lines of 'name value', durations in seconds
+        """
+        lines = []
+        for name, histogram in sorted(self.timings.items()):
+            lines.append('%s count %d' % (name, histogram.count))
+            lines.append('%s total %.6f' % (name, histogram.total))
+            lines.append('%s p50 %.6f' % (name, histogram.percentile(0.5)))
+            lines.append('%s p99 %.6f' % (name, histogram.percentile(0.99)))
+            lines.append('%s max %.6f' % (name, histogram.max))
+        for name, value in sorted(self.counters.items()):
+            lines.append('%s %d' % (name, value))
+        for name, value in sorted(self.values.items()):
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+stats = Stats()
+
+def summary(value):
+    """
+    returns value made fit for a log line: data (written, read) is
+    replaced by its size, long lists by their length
+    """
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, str):
+        if len(value) > 256:
+            return {'bytes': len(value)}
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, memoryview):
+        return {'bytes': len(value)}
+    if isinstance(value, dict):
+        return dict((k, summary(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        if len(value) > 8:
+            return {'items': len(value)}
+        return [summary(v) for v in value]
+    return type(value).__name__
+
+class Log:
+    """
+    Leveled logging, as JSON lines
+
+    Every FUSE operation is logged at the level 'debug', one in sample
+    of them if sample > 1, with the size of the data instead of the
+    data. At the default level 'warning', logging an operation costs a
+    comparison.
+
+    usage:
+
+    >>>  log.configure('info', 1, sys.stdout)
+    >>>  log.write('info', msg='unlocking', method='reflink')
+    >>>  if log.sampled():
+    >>>    log.write('debug', op='read', path=path, ...)
+    """
+    levels = ('error', 'warning', 'info', 'debug')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure('warning', 1, sys.stdout)
+
+    def configure(self, level, sample, output):
+        self.level = self.levels.index(level)
+        self.sample = sample
+        self.output = output
+        self.calls = itertools.count()
+
+    def enabled(self, level):
+        return self.levels.index(level) <= self.level
+
+    def sampled(self):
+        """
+        returns whether to log the current operation
+        """
+        if self.level < 3:
+            return False
+        return self.sample <= 1 or next(self.calls) % self.sample == 0
+
+    def write(self, level, **fields):
+        if not self.enabled(level):
+            return
+        fields['time'] = round(time.time(), 6)
+        fields['level'] = level
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+log = Log()
+
+class Trace:
+    """
+    Records the operations as JSON lines, for replay.py to replay them
+
+    Paths and short strings are decoded as latin-1, so that any name
+    comes back byte for byte. Data written is recorded as its size, and
+    so are the buffers read into.
+
+    usage:
+
+    >>>  trace = Trace(open('ops.trace', 'a'))
+    >>>  trace.record(op, path, args, ret, errno, start, seconds)
+    """
+    def __init__(self, output):
+        self.output = output
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def value(self, value):
+        if isinstance(value, str):
+            if len(value) > 256:
+                return {'bytes': len(value)}
+            return value.decode('latin-1')
+        if isinstance(value, memoryview):
+            return {'bytes': len(value)}
+        if isinstance(value, (list, tuple, dict)):
+            return summary(value)
+        if value is None or isinstance(value, (bool, int, long, float)):
+            return value
+        return {'buffer': type(value).__name__}
+
+    def record(self, op, path, args, ret, errno, start, seconds):
+        line = json.dumps({'time': round(start - self.start, 6),
+            'thread': threading.current_thread().name, 'op': op,
+            'path': path.decode('latin-1'),
+            'args': [self.value(arg) for arg in args],
+            'ret': self.value(ret), 'errno': errno,
+            'seconds': round(seconds, 6)}, sort_keys=True)
+        with self.lock:
+            self.output.write(line + '\n')
+
+def _stat_signature(path):
+    """
+    returns something that changes whenever the file at path is modified,
+    replaced or removed
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+def _wildmatch_regex(pattern):
+    """
+    translates a gitignore pattern to a regular expression, following
+    the rules of git's wildmatch() with WM_PATHNAME: '*', '?' and
+    brackets never match a slash, and '**' only crosses directories when
+    it is a full path component.
+    """
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i):
+                j = i + 2
+                while j < n and pattern[j] == '*':
+                    j += 1
+                starts = i == 0 or pattern[i-1] == '/'
+                if starts and j == n:
+                    res.append('.*')
+                    i = j
+                    continue
+                if starts and pattern[j] == '/':
+                    res.append('(?:.*/)?')
+                    i = j + 1
+                    continue
+            while i < n and pattern[i] == '*':
+                i += 1
+            res.append('[^/]*')
+            continue
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            negate = j < n and pattern[j] in '!^'
+            if negate:
+                j += 1
+            chars = []
+            first = True
+            while j < n and (first or pattern[j] != ']'):
+                first = False
+                if pattern.startswith('[:', j):
+                    end = pattern.find(':]', j + 2)
+                    if end != -1:
+                        chars.append(_BRACKET_CLASSES.get(
+                            pattern[j+2:end], ''))
+                        j = end + 2
+                        continue
+                if pattern[j] == '\\' and j + 1 < n:
+                    j += 1
+                if (j + 2 < n and pattern[j+1] == '-' and
+                        pattern[j+2] != ']'):
+                    chars.append('%s-%s' % (re.escape(pattern[j]),
+                        re.escape(pattern[j+2])))
+                    j += 3
+                else:
+                    chars.append(re.escape(pattern[j]))
+                    j += 1
+            if j >= n:
+                # unterminated bracket: wildmatch never matches it
+                return None
+            if negate:
+                res.append('[^/%s]' % ''.join(chars))
+            else:
+                res.append('(?!/)[%s]' % ''.join(chars))
+            i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return re.compile(''.join(res) + r'\Z', re.DOTALL)
+
+_BRACKET_CLASSES = {
+        'alnum': 'a-zA-Z0-9', 'alpha': 'a-zA-Z', 'blank': ' \\t',
+        'cntrl': '\\x00-\\x1f\\x7f', 'digit': '0-9', 'graph': '!-~',
+        'lower': 'a-z', 'print': ' -~', 'punct': '!-/:-@\\[-`{-~',
+        'space': ' \\t\\n\\r\\f\\v', 'upper': 'A-Z', 'xdigit': '0-9a-fA-F'}
+
+class IgnoreRules:
+    """
+    The patterns of one ignore file, in the order git reads them.
+
+    base is the directory (relative to the root of the repository, with
+    a trailing '/', or '') the patterns are relative to.
+    """
+    def __init__(self, text, base=''):
+        self.base = base
+        self.patterns = []
+        if text.startswith('\xef\xbb\xbf'):
+            text = text[3:]
+        for line in text.split('\n'):
+            if line.endswith('\r'):
+                line = line[:-1]
+            # trailing spaces are dropped unless escaped with a backslash
+            stripped = line.rstrip(' ')
+            if stripped.endswith('\\') and len(stripped) < len(line):
+                stripped += ' '
+            line = stripped
+            if not line or line.startswith('#'):
+                continue
+            negative = line.startswith('!')
+            if negative:
+                line = line[1:]
+            mustbedir = line.endswith('/')
+            if mustbedir:
+                line = line.rstrip('/')
+            if not line:
+                continue
+            basename_only = '/' not in line
+            if line.startswith('/'):
+                line = line[1:]
+            regex = _wildmatch_regex(line)
+            if regex is not None:
+                self.patterns.append((regex, negative, mustbedir,
+                    basename_only))
+
+    def match(self, path, isdir):
+        """
+        returns True if path is excluded by these rules, False if it is
+        explicitly re-included, None if no pattern matches
+        """
+        if not path.startswith(self.base):
+            return None
+        relative = path[len(self.base):]
+        basename = relative.rsplit('/', 1)[-1]
+        for regex, negative, mustbedir, basename_only in \
+                reversed(self.patterns):
+            if mustbedir and not isdir:
+                continue
+            if regex.match(basename if basename_only else relative):
+                return not negative
+        return None
+
+class IgnoreCache:
+    """
+    In process equivalent of 'git ls-files -c -o -d -m --exclude-standard'
+    for one path at a time.
+
+    The set of tracked paths is read from the index once, then updated
+    with the paths commits add and remove (see changed()). The ignore
+    files (every .gitignore, .git/info/exclude and core.excludesFile) are
+    parsed once. Each of them is read again only when its size, mtime or
+    inode changed, and the index when something else changed it.
+    Assumes operating from the root of the git directory.
+    """
+    config_files = ['.git/config',
+            os.path.expanduser('~/.gitconfig'),
+            os.path.join(os.environ.get('XDG_CONFIG_HOME',
+                os.path.expanduser('~/.config')), 'git', 'config')]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tracked = set()
+        self.index_signature = None
+        self.config_signature = None
+        self.excludes_file = None
+        self.rules = {}
+
+    def refresh_tracked(self):
+        """
+        reloads the set of tracked paths if the index changed
+        """
+        signature = _stat_signature('.git/index')
+        if signature != self.index_signature:
+            output = subprocess.Popen(['git', 'ls-files', '-z', '--cached'],
+                    stdout=subprocess.PIPE).communicate()[0]
+            self.tracked = set(output.split('\0'))
+            self.index_signature = signature
+
+    def changed(self, signature, added, removed):
+        """
+        the index, which had signature, now also tracks added and no
+        longer removed (paths relative to the root): the tracked paths
+        are updated in place, unless the index was not the one they were
+        read from
+        """
+        with self.lock:
+            if signature != self.index_signature:
+                return
+            self.tracked.update(added)
+            self.tracked.difference_update(removed)
+            self.index_signature = _stat_signature('.git/index')
+
+    def global_excludes_file(self):
+        """
+        returns the path of core.excludesFile, defaulting like git does
+        """
+        signature = [_stat_signature(f) for f in self.config_files]
+        if signature != self.config_signature:
+            value = subprocess.Popen(['git', 'config', '--path', '--get',
+                'core.excludesfile'],
+                stdout=subprocess.PIPE).communicate()[0].strip()
+            if not value:
+                value = os.path.join(os.environ.get('XDG_CONFIG_HOME',
+                    os.path.expanduser('~/.config')), 'git', 'ignore')
+            self.excludes_file = value
+            self.config_signature = signature
+        return self.excludes_file
+
+    def load(self, filename, base=''):
+        """
+        returns the up to date IgnoreRules of the given file
+        """
+        signature = _stat_signature(filename)
+        cached = self.rules.get(filename)
+        if cached is None or cached[0] != signature:
+            text = ''
+            if signature is not None:
+                try:
+                    with open(filename) as f:
+                        text = f.read()
+                except IOError:
+                    pass
+            cached = (signature, IgnoreRules(text, base))
+            self.rules[filename] = cached
+        return cached[1]
+
+    def excluded(self, path, isdir, ruleslists):
+        """
+        git gives precedence to the deepest .gitignore, then to
+        info/exclude, then to core.excludesFile
+        """
+        for rules in ruleslists:
+            res = rules.match(path, isdir)
+            if res is not None:
+                return res
+        return False
+
+    def ignored(self, path):
+        """
+        path is relative to the root of the repository, without leading
+        './'. Returns True if 'git ls-files -c -o -d -m --exclude-standard'
+        would not list it.
+        """
+        with self.lock:
+            self.refresh_tracked()
+            if path in self.tracked:
+                return False
+            try:
+                st = os.lstat(path)
+            except OSError:
+                return True
+            if stat.S_ISDIR(st.st_mode):
+                return True
+            ruleslists = [self.load('.git/info/exclude'),
+                    self.load(self.global_excludes_file())]
+            base = ''
+            for component in path.split('/')[:-1]:
+                ruleslists.insert(0, self.load(base + '.gitignore', base))
+                base += component
+                # an excluded directory is not traversed, and a nested
+                # repository is not ours to list
+                if (self.excluded(base, True, ruleslists) or
+                        os.path.exists(base + '/.git')):
+                    return True
+                base += '/'
+            ruleslists.insert(0, self.load(base + '.gitignore', base))
+            return self.excluded(path, False, ruleslists)
+
+ignore_cache = IgnoreCache()
+
 def ignored(path):
     """
     Returns true if we should ignore this file, false otherwise. This
@@ -61,11 +598,7 @@ def ignored(path):
             path_ == '.command'):
         return True
     else:
-        ls_options = "-c -o -d -m --full-name --exclude-standard"
-        considered = subprocess.Popen(
-                shlex.split('git ls-files %s -- "%s"' % (ls_options, path_)),
-                stdout=subprocess.PIPE).communicate()[0].strip().split('\n')
-        return path_ not in considered
+        return ignore_cache.ignored(path_)
 
 def annexed(path):
     """
@@ -74,20 +607,2050 @@ def annexed(path):
     return (os.path.islink(path) and
             os.readlink(path).count('.git/annex/objects'))
 
-def shell_do(cmd):
+def parent(path):
+    """
+    returns the parent directory of path, as the operations get it:
+    './' for the root
+    """
+    dirname = os.path.dirname(path.rstrip('/'))
+    if dirname in ('', '.'):
+        return './'
+    return dirname
+
+class MetadataSnapshot:
+    """
+    What the MetadataCache knew at the previous unmount, memory-mapped so
+    that a new mount doesn't have to look at every path again
+
+    filename holds a JSON header, then one line per annexed link, sorted:
+    'path\0target\0flags\0stat', flags being 'a' if annexed and 'p' if
+    present, stat the 10 fields of os.stat_result. lookup() does a binary
+    search in the mapping.
+
+    The snapshot is only used if HEAD, the index and the git-annex branch
+    are the ones it was saved with. These tell nothing about the files
+    that are not annexed, which may be changed while unmounted: only the
+    annexed links are saved, their content can't change behind them. Its file is removed once mapped: after
+    a crash, the next mount starts cold rather than stale. The paths
+    invalidated since the mount are not looked up in it anymore.
+
+    usage:
+
+    >>>  snapshot = MetadataSnapshot()
+    >>>  snapshot.lookup('./foo')
+    (st, target, annexed, present)
+    >>>  snapshot.save(entries)
+    """
+    format = 2
+
+    def __init__(self, filename='.git/sharebox/metadata'):
+        self.filename = filename
+        self.map = None
+        self.start = 0
+        self.invalidated = set()
+        self.prefixes = []
+        self.load()
+
+    def signature(self):
+        """
+        what the snapshot is valid for, as it reads back from JSON
+        """
+        return json.loads(json.dumps({'format': self.format,
+            'head': read_ref('.git', 'HEAD'),
+            'index': _stat_signature('.git/index'),
+            'annex': read_ref('.git', 'refs/heads/git-annex')}))
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                header = f.readline()
+                if json.loads(header) == self.signature():
+                    self.map = mmap.mmap(f.fileno(), 0,
+                            access=mmap.ACCESS_READ)
+                    self.start = len(header)
+        except (EnvironmentError, ValueError):
+            self.map = None
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+    def valid(self, path):
+        """
+        whether what the snapshot says of path still holds
+        """
+        return (self.map is not None and path not in self.invalidated and
+                not any(path.startswith(prefix) for prefix in self.prefixes))
+
+    def lookup(self, path):
+        """
+        returns a (st, target, annexed, present) tuple, None if path is
+        not in the snapshot
+        """
+        if not self.valid(path):
+            return None
+        m = self.map
+        lo, hi = self.start, len(m)
+        while lo < hi:
+            begin = max(m.rfind('\n', lo, (lo + hi) // 2) + 1, lo)
+            end = m.find('\n', begin, hi)
+            line = m[begin:end]
+            name = line[:line.find('\0')]
+            if name == path:
+                return self.parse(line)
+            elif name < path:
+                lo = end + 1
+            else:
+                hi = begin
+        return None
+
+    def parse(self, line):
+        path, target, flags, fields = line.split('\0')
+        fields = fields.split()
+        st = os.stat_result([int(f) for f in fields[:7]] +
+                [float(f) for f in fields[7:]])
+        return st, target or None, 'a' in flags, 'p' in flags
+
+    def format_line(self, path, entry):
+        st, target, annexed, present = entry
+        return '%s\0%s\0%s%s\0%s\n' % (path, target or '',
+                'a' if annexed else '', 'p' if present else '',
+                ' '.join([str(f) for f in (st.st_mode, st.st_ino,
+                    st.st_dev, st.st_nlink, st.st_uid, st.st_gid,
+                    st.st_size)] + [repr(float(t)) for t in (st.st_atime,
+                        st.st_mtime, st.st_ctime)]))
+
+    def invalidate(self, path, recursive=False):
+        self.invalidated.add(path)
+        self.invalidated.add(parent(path))
+        if recursive:
+            self.prefixes.append(path.rstrip('/') + '/')
+
+    def clear(self):
+        self.map = None
+
+    def save(self, entries):
+        """
+        writes the annexed links of entries ({path: (st, target, annexed,
+        present)}) and what is still valid of the snapshot for the next
+        mount
+        """
+        lines = {}
+        if self.map is not None:
+            for line in self.map[self.start:].split('\n'):
+                path = line[:line.find('\0')]
+                if line and self.valid(path):
+                    lines[path] = line + '\n'
+        for path, entry in entries.items():
+            if (entry[2] and '\n' not in path and
+                    '\n' not in (entry[1] or '')):
+                lines[path] = self.format_line(path, entry)
+        with open(self.filename + '.new', 'wb') as f:
+            f.write(json.dumps(self.signature()) + '\n')
+            for path in sorted(lines):
+                f.write(lines[path])
+        os.rename(self.filename + '.new', self.filename)
+
+class MetadataCache:
+    """
+    Bounded, thread safe cache of what we learn with lstat/readlink/stat
+    about a path: its lstat, the target of the link if it is one, whether
+    the link is annexed and whether its content is present. For present
+    annexed files, the stat is the one of the content.
+
+    Errors are not cached. Whoever modifies a path has to invalidate it.
+    A lookup racing with an invalidation is simply not stored.
+
+    What is not cached is looked up in snapshot (a MetadataSnapshot, if
+    any) before the filesystem. save() writes the snapshot for the next
+    mount.
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.snapshot = None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.snapshot_hits = 0
+
+    def lookup(self, path):
+        """
+        returns a (st, target, annexed, present) tuple, raises OSError if
+        the path can't be stat-ed
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                # until the cache is full nothing is evicted: the order of
+                # the entries doesn't matter yet, and a hit costs no move
+                if len(self.entries) >= self.maxsize:
+                    del self.entries[path]
+                    self.entries[path] = entry
+                self.hits += 1
+                return entry
+            if self.snapshot is not None:
+                entry = self.snapshot.lookup(path)
+                if entry is not None:
+                    self.store(path, entry)
+                    self.snapshot_hits += 1
+                    return entry
+            self.misses += 1
+            generation = self.generation
+        st = os.lstat(path)
+        target = None
+        annexed = present = False
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(path)
+            annexed = '.git/annex/objects' in target
+            if annexed:
+                try:
+                    st = os.stat(path)
+                    present = True
+                except OSError:
+                    pass
+        entry = (st, target, annexed, present)
+        with self.lock:
+            if generation == self.generation:
+                self.store(path, entry)
+        return entry
+
+    def store(self, path, entry):
+        self.entries[path] = entry
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def annexed(self, path):
+        """
+        cached equivalent of annexed(path)
+        """
+        try:
+            return self.lookup(path)[2]
+        except OSError:
+            return False
+
+    def readlink(self, path):
+        target = self.lookup(path)[1]
+        if target is None:
+            raise FuseOSError(EINVAL)
+        return target
+
+    def invalidate(self, path, recursive=False):
+        """
+        forgets about path and its parent directory (whose size, nlink
+        and mtime change when entries are added or removed). If recursive,
+        also forgets everything below path.
+        """
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(path, None)
+            self.entries.pop(parent(path), None)
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                for cached in [p for p in self.entries
+                        if p.startswith(prefix)]:
+                    del self.entries[cached]
+            if self.snapshot is not None:
+                self.snapshot.invalidate(path, recursive)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            if self.snapshot is not None:
+                self.snapshot.clear()
+
+    def save(self):
+        """
+        saves what is known for the next mount
+        """
+        with self.lock:
+            if self.snapshot is not None:
+                self.snapshot.save(self.entries)
+
+class KernelCache:
+    """
+    Makes the kernel forget what it caches about the paths changed behind
+    its back (by a merge, a commit, a 'git annex get'), so that it can be
+    told to cache attributes and entries for long.
+
+    The high level API of libfuse doesn't tell the inode numbers it gives
+    to the kernel, but the one of the root: a path is forgotten through
+    its entry in the root, along with everything cached below it. The
+    kernel locks the directory to do so, and an operation being served
+    may hold that lock: the invalidations are done by a thread of their
+    own. drain() waits for it.
+
+    usage:
+
+    >>>  kernel = KernelCache()
+    >>>  kernel.start()
+    >>>  kernel.invalidate('./foo/bar', './baz')
+    >>>  kernel.drain()
+    """
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.names = set()
+        self.busy = False
+        self.stopped = False
+        self.thread = None
+        self.invalidated = 0
+
+    def start(self):
+        if notify_supported and self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def invalidate(self, *paths):
+        """
+        forgets about paths and everything below them. The attributes of
+        the root are only forgotten if it is one of them.
+        """
+        if self.thread is None:
+            return
+        with self.cond:
+            for path in paths:
+                self.names.add(os.path.normpath(path).split('/')[0])
+            self.cond.notify_all()
+
+    def drain(self):
+        """
+        waits until the kernel forgot everything invalidated so far. Not
+        with a lock an operation may wait for: the kernel may have to
+        wait for that operation first.
+        """
+        if self.thread is None:
+            return
+        with self.cond:
+            while (self.names or self.busy) and not self.stopped:
+                self.cond.wait()
+
+    def invalidate_all(self, names=()):
+        """
+        forgets about everything in the root, and about names too (the
+        ones that were there before)
+        """
+        names = set(os.listdir('.')).union(names)
+        names.discard('.git')
+        self.invalidate('.', *names)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.names and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                names, self.names = self.names, set()
+                self.busy = True
+            root = '.' in names
+            names.discard('.')
+            for name in names:
+                # ENOENT if the kernel had not looked it up: nothing to do
+                notify_inval_entry(FUSE_ROOT_ID, name)
+            if root:
+                notify_inval_inode(FUSE_ROOT_ID)
+            self.invalidated += len(names)
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+class RWLock:
+    """
+    Readers-writer lock. Writers are preferred: once one waits, new
+    readers wait too. Not reentrant.
+    """
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire(self, shared):
+        start = None
+        with self.cond:
+            if shared:
+                while self.writer or self.waiting_writers:
+                    start = start or time.time()
+                    self.cond.wait()
+                self.readers += 1
+            else:
+                self.waiting_writers += 1
+                while self.writer or self.readers:
+                    start = start or time.time()
+                    self.cond.wait()
+                self.waiting_writers -= 1
+                self.writer = True
+        if start is not None:
+            stats.time('rwlock wait %s' % ('shared' if shared else
+                'exclusive'), time.time() - start)
+
+    def release(self, shared):
+        with self.cond:
+            if shared:
+                self.readers -= 1
+            else:
+                self.writer = False
+            self.cond.notify_all()
+
+class Locked:
+    """
+    Holds the locks of a LockManager for the duration of an operation:
+    the tree lock (shared unless exclusive), then the lock of each path,
+    always in the same order.
     """
-    calls the given shell command
+    def __init__(self, manager, paths, shared, exclusive=False):
+        self.manager = manager
+        self.paths = sorted(set(paths))
+        self.shared = shared
+        self.exclusive = exclusive
+
+    def __enter__(self):
+        self.manager.tree.acquire(not self.exclusive)
+        for path in self.paths:
+            self.manager.acquire(path, self.shared)
+
+    def __exit__(self, type, value, traceback):
+        for path in reversed(self.paths):
+            self.manager.release(path, self.shared)
+        self.manager.tree.release(not self.exclusive)
+
+class LockManager:
+    """
+    Locks of the filesystem
+
+    - tree is held shared by every operation, and exclusively by whatever
+      rewrites the working tree behind our back (merges);
+    - every path has its own readers-writer lock, created when first
+      needed and dropped when nobody holds it;
+    - git serializes the git commands that touch the index or commit.
+
+    Locks are always taken in this order: tree, paths (sorted), git.
+
+    usage:
+
+    >>>  with locks.read(path):
+    >>>    os.read(...)
+    >>>  with locks.write(old, new):
+    >>>    os.rename(old, new)
+    >>>  with locks.exclusive():
+    >>>    shell_do('git merge ...')
     """
-    if foreground:
-        print cmd
-    p = None
-    stdin = None
-    for i in cmd.split('|'):
-        p = subprocess.Popen(shlex.split(i), stdin=stdin, stdout=subprocess.PIPE)
-        stdin = p.stdout
-    p.wait()
+    def __init__(self):
+        self.tree = RWLock()
+        self.git = threading.Lock()
+        self.mutex = threading.Lock()
+        self.paths = {}
+
+    def read(self, *paths):
+        return Locked(self, paths, shared=True)
+
+    def write(self, *paths):
+        return Locked(self, paths, shared=False)
+
+    def exclusive(self):
+        return Locked(self, (), shared=False, exclusive=True)
+
+    def acquire(self, path, shared):
+        with self.mutex:
+            entry = self.paths.get(path)
+            if entry is None:
+                entry = self.paths[path] = [RWLock(), 0]
+            entry[1] += 1
+        entry[0].acquire(shared)
+
+    def release(self, path, shared):
+        with self.mutex:
+            entry = self.paths[path]
+            entry[0].release(shared)
+            entry[1] -= 1
+            if not entry[1]:
+                del self.paths[path]
+
+libc = CDLL(find_library('c'), use_errno=True)
+try:
+    libc_pread = libc.pread64  # 64 bits offsets on 32 bits glibc
+except AttributeError:
+    libc_pread = libc.pread
+libc_pread.restype = c_ssize_t
+libc_pread.argtypes = [c_int, c_void_p, c_size_t, c_longlong]
+
+def pread(fd, buf, size, offset):
+    """
+    reads at most size bytes at offset in fd into the ctypes buffer buf,
+    returns how many were read
+    """
+    res = libc_pread(fd, buf, size, offset)
+    if res < 0:
+        errno = get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return res
+
+try:
+    libc_copy_file_range = libc.copy_file_range
+    libc_copy_file_range.restype = c_ssize_t
+    libc_copy_file_range.argtypes = [c_int, POINTER(c_longlong), c_int,
+            POINTER(c_longlong), c_size_t, c_uint]
+except AttributeError:
+    libc_copy_file_range = None # glibc < 2.27
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int)
+
+unlock_methods = ('reflink', 'copy_file_range', 'copy')
+_unlock_methods = {} # st_dev -> the best of unlock_methods there
+
+def clone_file(src, dst, method):
+    """
+    copies the content of the file descriptor src to the empty file
+    descriptor dst with method: 'reflink' shares the blocks of src
+    (btrfs, XFS), 'copy_file_range' copies within the kernel, 'copy'
+    through userspace. Raises EnvironmentError if method is not supported
+    there.
+    """
+    if method == 'reflink':
+        fcntl.ioctl(dst, FICLONE, src)
+    elif method == 'copy_file_range':
+        if libc_copy_file_range is None:
+            raise OSError(EINVAL, 'copy_file_range is not available')
+        offset_src = c_longlong(0)
+        offset_dst = c_longlong(0)
+        while True:
+            res = libc_copy_file_range(src, byref(offset_src), dst,
+                    byref(offset_dst), 1 << 30, 0)
+            if res < 0:
+                errno = get_errno()
+                raise OSError(errno, os.strerror(errno))
+            if res == 0:
+                break
+    else:
+        os.lseek(src, 0, os.SEEK_SET)
+        while True:
+            data = os.read(src, 1 << 20)
+            if not data:
+                break
+            os.write(dst, data)
+
+def unlock_method(directory):
+    """
+    returns the fastest of unlock_methods that works on the filesystem of
+    directory, trying them once per filesystem
+    """
+    dev = os.stat(directory).st_dev
+    if dev not in _unlock_methods:
+        src, srcname = tempfile.mkstemp(dir=directory)
+        dst, dstname = tempfile.mkstemp(dir=directory)
+        try:
+            os.write(src, 'x' * 4096)
+            for method in unlock_methods:
+                try:
+                    os.ftruncate(dst, 0)
+                    clone_file(src, dst, method)
+                    break
+                except EnvironmentError:
+                    pass
+            _unlock_methods[dev] = method
+        finally:
+            os.close(src)
+            os.close(dst)
+            os.remove(srcname)
+            os.remove(dstname)
+    return _unlock_methods[dev]
+
+def unlock(path, empty=False):
+    """
+    in process 'git annex unlock path': replaces the link to the annexed
+    content by a writable copy of it, as cheap as the filesystem of
+    .git/sharebox allows. Falls back to git annex if that fails.
+
+    If empty, the link is replaced by an empty file instead: the content
+    is about to be truncated, and doesn't even have to be present.
+    """
+    tmp = None
+    try:
+        if empty:
+            dst, tmp = tempfile.mkstemp(dir='.git/sharebox')
+            os.fchmod(dst, 0644)
+            os.close(dst)
+            os.rename(tmp, path)
+            return True
+        method = unlock_method('.git/sharebox')
+        src = os.open(path, os.O_RDONLY)
+        try:
+            st = os.fstat(src)
+            dst, tmp = tempfile.mkstemp(dir='.git/sharebox')
+            try:
+                clone_file(src, dst, method)
+                os.fchmod(dst, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+            finally:
+                os.close(dst)
+        finally:
+            os.close(src)
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        os.rename(tmp, path)
+        return True
+    except EnvironmentError:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return shell_do(['git', 'annex', 'unlock', '--', path])
+
+def head():
+    """
+    returns the sha1 of HEAD, or None if there is no commit yet
+    """
+    p = subprocess.Popen(['git', 'rev-parse', '--verify', '-q', 'HEAD'],
+            stdout=subprocess.PIPE)
+    res = p.communicate()[0].strip()
+    return res or None
+
+def remotes():
+    """
+    returns the names of the remotes
+    """
+    output = subprocess.Popen(['git', 'remote'],
+            stdout=subprocess.PIPE).communicate()[0]
+    return output.split()
+
+def changed_paths(old, new):
+    """
+    returns the paths that differ between the commits old and new
+    """
+    if old == new:
+        return []
+    if old is None:
+        cmd = ['git', 'ls-tree', '-r', '-z', '--name-only', new]
+    else:
+        cmd = ['git', 'diff', '-z', '--name-only', '--no-renames', old, new]
+    output = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+    return [p for p in output.split('\0') if p]
+
+def annex_backend():
+    """
+    returns the backend git-annex adds files with
+    """
+    for option in ('annex.backends', 'annex.backend'):
+        output = subprocess.Popen(['git', 'config', option],
+                stdout=subprocess.PIPE).communicate()[0]
+        if output.split():
+            return output.split()[0]
+    return 'SHA256E'
+
+def terminate(p):
+    try:
+        p.terminate()
+    except OSError:
+        pass
+
+def shell_do(cmd, timeout=None):
+    """
+    calls the given shell command. A list is taken as an argument vector
+    and is not split, which is what you want for arbitrary paths; it can
+    be given a timeout in seconds, after which it is terminated and
+    considered failed.
+    """
+    log.write('info', cmd=summary(cmd if isinstance(cmd, list) else [cmd]))
+    start = time.time()
+    if isinstance(cmd, list):
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        if timeout is not None:
+            timer = threading.Timer(timeout, terminate, [p])
+            timer.start()
+        p.communicate()
+        if timeout is not None:
+            timer.cancel()
+        argv = cmd
+    else:
+        p = None
+        stdin = None
+        for i in cmd.split('|'):
+            p = subprocess.Popen(shlex.split(i), stdin=stdin,
+                    stdout=subprocess.PIPE)
+            stdin = p.stdout
+        p.wait()
+        argv = cmd.split()
+    # 'git annex get', 'git commit', 'notify-send'...
+    name = ' '.join(argv[:3] if argv[1:2] == ['annex'] else argv[:2])
+    stats.time('subprocess %s' % name, time.time() - start)
     return not p.returncode # will return True if everything ok
 
+def fix_annex_link(old, new):
+    """
+    git-annex links are relative: after moving one from old to new in a
+    directory of a different depth, point it to the same content again.
+    """
+    if not os.path.islink(new):
+        return
+    target = os.readlink(new)
+    if '.git/annex/objects' not in target or os.path.isabs(target):
+        return
+    content = os.path.normpath(os.path.join(os.path.dirname(old), target))
+    fixed = os.path.relpath(content, os.path.dirname(new))
+    if fixed != target:
+        os.unlink(new)
+        os.symlink(fixed, new)
+
+class Coprocess:
+    """
+    A long lived 'git ... --batch' process
+
+    Answers one query at a time, whatever the thread asking: a line in, a
+    response out. Started on the first query, and started again if it
+    dies. If it can't run at all (e.g. a git-annex without --batch),
+    query() returns None and the caller falls back to a process per
+    command.
+
+    usage:
+
+    >>>  hashobject = Coprocess(['git', 'hash-object', '-w',
+    >>>          '--stdin-paths'], gitdir)
+    >>>  sha1 = hashobject.query('foo')
+    """
+    def __init__(self, cmd, cwd):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.process = None
+        self.answered = False
+        self.broken = False
+        self.lock = threading.Lock()
+
+    def response(self):
+        """
+        reads the response to a query, None if the process died
+        """
+        line = self.process.stdout.readline()
+        if not line:
+            return None
+        return line[:-1]
+
+    def query(self, line):
+        """
+        returns the response to line, None if the process can't answer
+        """
+        start = time.time()
+        with self.lock:
+            for attempt in range(2):
+                if self.broken:
+                    return None
+                res = None
+                try:
+                    if self.process is None:
+                        self.process = subprocess.Popen(self.cmd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, cwd=self.cwd,
+                                close_fds=True)
+                    self.process.stdin.write(line + '\n')
+                    self.process.stdin.flush()
+                    res = self.response()
+                except EnvironmentError:
+                    pass
+                if res is not None:
+                    self.answered = True
+                    stats.time('batch %s' % ' '.join(arg for arg in
+                        self.cmd[1:] if not arg.startswith('--')),
+                        time.time() - start)
+                    return res
+                self._stop()
+                # dying twice without ever answering: it won't work
+                self.broken = attempt == 1 and not self.answered
+            return None
+
+    def stop(self):
+        with self.lock:
+            self._stop()
+
+    def _stop(self):
+        if self.process is not None:
+            terminate(self.process)
+            self.process.wait()
+            self.process = None
+
+class CatFile(Coprocess):
+    """
+    'git cat-file --batch': query() returns a (type, content) tuple,
+    ('missing', '') for unknown objects
+    """
+    def __init__(self, cwd):
+        Coprocess.__init__(self, ['git', 'cat-file', '--batch'], cwd)
+
+    def response(self):
+        header = self.process.stdout.readline()
+        if not header:
+            return None
+        fields = header.split()
+        if len(fields) != 3:
+            return ('missing', '')
+        size = int(fields[2])
+        content = self.process.stdout.read(size + 1)
+        if len(content) != size + 1:
+            return None
+        return (fields[1], content[:-1])
+
+class AnnexBatch(Coprocess):
+    """
+    'git annex <command> --batch --json': query() returns the JSON object
+    of the response, {} for the blank line of a path the command has
+    nothing to do with. The human readable output may take several lines
+    for one path, the JSON one always takes one.
+    """
+    def __init__(self, command, cwd):
+        Coprocess.__init__(self, ['git', 'annex', command, '--batch',
+            '--json'], cwd)
+
+    def response(self):
+        line = self.process.stdout.readline()
+        if not line:
+            return None
+        if not line.strip():
+            return {}
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None # out of step with the queries: started again
+
+class CoprocessPool:
+    """
+    Up to size Coprocesses made by new(), for as many queries in parallel
+    """
+    def __init__(self, new, size):
+        self.new = new
+        self.size = size
+        self.idle = []
+        self.count = 0
+        self.cond = threading.Condition()
+
+    def query(self, line):
+        with self.cond:
+            while not self.idle and self.count >= self.size:
+                self.cond.wait()
+            if self.idle:
+                coprocess = self.idle.pop()
+            else:
+                coprocess = self.new()
+                self.count += 1
+        try:
+            return coprocess.query(line)
+        finally:
+            with self.cond:
+                self.idle.append(coprocess)
+                self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            for coprocess in self.idle:
+                coprocess.stop()
+
+class GitBatch:
+    """
+    The long lived git and git-annex processes of a ShareBox
+
+    A query to them costs a round trip through a pipe instead of starting
+    git-annex (and opening the repository) again. Every method falls back
+    to running a command if the batch mode is not available.
+
+    usage:
+
+    >>>  batch = GitBatch(gitdir, getjobs)
+    >>>  batch.annex_get('./foo')
+    """
+    def __init__(self, gitdir, getjobs=1):
+        self.add = AnnexBatch('add', gitdir)
+        self.get = CoprocessPool(lambda: AnnexBatch('get', gitdir), getjobs)
+        self.catfile = CatFile(gitdir)
+        self.catcheck = Coprocess(['git', 'cat-file', '--batch-check'],
+                gitdir)
+
+    def annex_add(self, paths):
+        """
+        'git annex add' of paths, all of them staged afterwards. Only what
+        the batch annexed is staged with 'git add': anything else would
+        put the content itself in git. The rest goes through a command.
+        """
+        stats.count('annex add', len(paths))
+        added, unbatched = [], []
+        for path in paths:
+            res = None if '\n' in path else self.add.query(path)
+            if res is not None and res.get('success'):
+                added.append(path)
+            else:
+                unbatched.append(path)
+        if added:
+            # batch mode may only stage them when the process exits
+            shell_do(['git', 'add', '--'] + added)
+        if unbatched:
+            shell_do(['git', 'annex', 'add', '--'] + unbatched)
+
+    def annex_get(self, path):
+        """
+        'git annex get' of path, returns whether its content is present
+        """
+        stats.count('annex get')
+        if '\n' in path or self.get.query(path) is None:
+            shell_do(['git', 'annex', 'get', '--', path])
+        return os.path.exists(path)
+
+    def cat(self, obj):
+        """
+        returns the content of the git object obj, None if it doesn't
+        exist
+        """
+        res = self.catfile.query(obj)
+        if res is None:
+            p = subprocess.Popen(['git', 'cat-file', '-p', obj],
+                    stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+            content = p.communicate()[0]
+            return None if p.returncode else content
+        if res[0] == 'missing':
+            return None
+        return res[1]
+
+    def size(self, obj):
+        """
+        returns the size of the git object obj, None if it doesn't exist
+        """
+        res = self.catcheck.query(obj)
+        if res is None:
+            p = subprocess.Popen(['git', 'cat-file', '-s', obj],
+                    stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+            output = p.communicate()[0]
+            return None if p.returncode else int(output)
+        fields = res.split()
+        if len(fields) != 3:
+            return None # '<obj> missing'
+        return int(fields[2])
+
+    def stop(self):
+        for coprocess in (self.add, self.get, self.catfile, self.catcheck):
+            coprocess.stop()
+
+class CommitQueue:
+    """
+    Group commit
+
+    Filesystem operations record the paths they changed, and flush()
+    brings the index in line with the working tree for all of them at
+    once: 'git annex add' for the paths that exist, 'git rm --cached' for
+    the ones that are gone, then a single 'git commit'.
+
+    If delay is 0, every add() flushes immediately. Otherwise a
+    background thread flushes delay seconds after the first pending
+    change, and add() flushes by itself once maxpending paths are
+    waiting.
+
+    lock is the lock serializing git commands, taken by add() and
+    flush(). Paths that are still open for writing are left pending:
+    annexing them would let the writer modify the annexed content. Open
+    them for writing with lock held and register them in writers.
+
+    Annexing a path replaces it by a link: the file shows the same
+    attributes, but the kernel is told to forget the ones of its parent
+    directory, whose mtime changed.
+
+    usage:
+
+    >>>  commits = CommitQueue(delay, lock, metadata, batch, kernel)
+    >>>  commits.start()
+    >>>  commits.add('changed %s' % path, path)
+    """
+    def __init__(self, delay, lock, metadata, batch, kernel,
+            maxpending=1000):
+        self.delay = delay
+        self.lock = lock
+        self.metadata = metadata
+        self.batch = batch
+        self.kernel = kernel
+        self.maxpending = maxpending
+        self.pending = OrderedDict()
+        self.writers = {}
+        self.keys = {}
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        if self.delay > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            time.sleep(self.delay)
+            self.flush()
+
+    def unlocked(self, path):
+        """
+        whether path was already unlocked: it is not a link anymore, or
+        another writer has it open. Call with lock held.
+        """
+        return path in self.writers.values() or not os.path.islink(path)
+
+    def closed(self, fh, changed=False):
+        """
+        fh, registered in writers, is not open anymore. Unless changed
+        (the caller adds its path right after), the change another
+        writer left pending because of fh is flushed as add() would.
+        """
+        with self.lock:
+            path = self.writers.pop(fh, None)
+            if (changed or path not in self.pending or
+                    path in self.writers.values()):
+                return
+            if self.delay <= 0 or self.thread is None:
+                self._flush()
+            else:
+                self.wakeup.set()
+
+    def hashed(self, path, key):
+        """
+        the current content of path has the annex key key: if path is
+        not modified again, flush() can annex it without hashing it
+        """
+        with self.lock:
+            self.keys[path] = (key, _stat_signature(path))
+
+    def add(self, message, *paths):
+        """
+        records that paths changed, message describing how
+        """
+        with self.lock:
+            for path in paths:
+                self.pending.setdefault(path, message)
+            if (self.delay <= 0 or self.thread is None or
+                    len(self.pending) >= self.maxpending):
+                self._flush()
+            else:
+                self.wakeup.set()
+
+    def flush(self):
+        """
+        commits everything pending
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, OrderedDict()
+        busy = set(self.writers.values())
+        added, removed = [], []
+        for path in pending.keys():
+            if path in busy:
+                self.pending[path] = pending.pop(path)
+            elif os.path.lexists(path) and not ignored(path):
+                added.append(path)
+            else:
+                # unlinked or renamed away: the key it was written with
+                # is of no use anymore
+                self.keys.pop(path, None)
+                if not ignored(path):
+                    removed.append(path)
+        index = _stat_signature('.git/index')
+        if removed and not shell_do(['git', 'rm', '--cached',
+                '--ignore-unmatch', '-q', '--'] + removed):
+            index = None # the tracked paths have to be read again
+        unhashed = []
+        for path in added:
+            key, signature = self.keys.pop(path, (None, None))
+            # setkey moves the content in the annex (without checking it
+            # again), fromkey replaces it by a link and stages it
+            if (key is None or signature != _stat_signature(path) or
+                    not shell_do(['git', 'annex', 'setkey',
+                        '-c', 'annex.verify=false', key, path])):
+                unhashed.append(path)
+            else:
+                shell_do(['git', 'annex', 'fromkey', key, path])
+        if unhashed:
+            self.batch.annex_add(unhashed)
+        if added or removed:
+            messages = []
+            for message in pending.values():
+                if message not in messages:
+                    messages.append(message)
+            if len(messages) == 1:
+                message = messages[0]
+            else:
+                message = '%d changes\n\n%s' % (len(messages),
+                        '\n'.join(messages))
+            shell_do(['git', 'commit', '-q', '-m', message])
+        if index is not None:
+            ignore_cache.changed(index, [path[2:] for path in added],
+                    [path[2:] for path in removed])
+        for path in pending:
+            self.metadata.invalidate(path)
+        self.kernel.invalidate(*set(parent(path) for path in added))
+
+def key_size(key):
+    """
+    returns the size of the content of a git-annex key (the 's' field of
+    BACKEND-sSIZE-mMTIME--NAME), None if the key does not tell
+    """
+    for field in key.split('--', 1)[0].split('-')[1:]:
+        if field.startswith('s') and field[1:].isdigit():
+            return int(field[1:])
+    return None
+
+class WriteHashes:
+    """
+    Annex keys computed while files are written
+
+    Hashes the data written to each file as it goes through write(), as
+    long as a single file descriptor writes it sequentially from the
+    start, so that the content doesn't have to be read again to annex it.
+    Keys are computed for backend if hashlib implements it, never
+    otherwise, and never for ignored files, which aren't annexed.
+
+    usage:
+
+    >>>  hashes = WriteHashes(annex_backend())
+    >>>  hashes.written(path, fh, offset, data)
+    >>>  key = hashes.key(path, fh)
+    """
+    algorithms = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.algorithm = backend.lower().rstrip('e')
+        if self.algorithm not in self.algorithms:
+            self.algorithm = None
+        self.lock = threading.Lock()
+        self.streams = {} # path -> [fh, hash, size]
+
+    def written(self, path, fh, offset, data):
+        """
+        data was written at offset in path through fh
+        """
+        if self.algorithm is None:
+            return
+        with self.lock:
+            stream = self.streams.get(path)
+            if stream is None and offset == 0 and not ignored(path):
+                stream = self.streams[path] = [fh,
+                        hashlib.new(self.algorithm), 0]
+            elif stream is None:
+                return
+            elif stream[0] != fh or stream[2] != offset:
+                del self.streams[path]
+                return
+        stream[1].update(data)
+        stream[2] += len(data)
+
+    def broken(self, path):
+        """
+        path was modified otherwise than by write()
+        """
+        with self.lock:
+            self.streams.pop(path, None)
+
+    def key(self, path, fh):
+        """
+        returns the key of path if fh wrote all of its content, None
+        otherwise. fh is done writing.
+        """
+        with self.lock:
+            stream = self.streams.get(path)
+            if stream is None or stream[0] != fh:
+                return None
+            del self.streams[path]
+        fh, digest, size = stream
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size != size:
+            return None
+        extension = ''
+        if self.backend.endswith('E'):
+            for ext in reversed(os.path.basename(path).split('.')[1:][-2:]):
+                if not (0 < len(ext) <= 4 and ext.isalnum()):
+                    break
+                extension = '.' + ext + extension
+        return '%s-s%d--%s%s' % (self.backend, size, digest.hexdigest(),
+                extension)
+
+getall_orders = ('largest', 'smallest')
+
+def get_missing(paths, metadata, batch, jobs=4, order='largest'):
+    """
+    runs 'git annex get' on the annexed files among paths whose content is
+    missing, jobs at a time, the largest (or smallest) first. Returns the
+    paths that could not be fetched.
+    """
+    missing = []
+    for path in paths:
+        try:
+            st, target, annexed, present = metadata.lookup(path)
+        except OSError:
+            continue
+        if annexed and not present:
+            size = key_size(os.path.basename(target)) or 0
+            missing.append((size, path))
+    missing.sort(reverse=(order == 'largest'))
+    queue = deque(path for size, path in missing)
+    failed = []
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                path = queue.popleft()
+            ok = batch.annex_get(path)
+            metadata.invalidate(path)
+            if not ok:
+                with lock:
+                    failed.append(path)
+    threads = [threading.Thread(target=worker)
+            for i in xrange(min(jobs, len(queue)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failed
+
+class Prefetcher:
+    """
+    Background 'git annex get' of the files likely to be opened next
+
+    When open() has to fetch a missing file, missed() has the missing
+    annexed files of the same directory queued, chosen by policy:
+    - 'dir': all of them, in name order starting after the opened file;
+    - 'ext': the same, restricted to the extension of the opened file;
+    - 'recent': all of them, most recently modified first;
+    - 'none': nothing.
+
+    jobs threads scan the directories, so that open() doesn't wait for
+    it, and run the gets. The content queued or being fetched never
+    exceeds budget bytes. A directory is not scanned again while files
+    of it are still queued or being fetched.
+
+    Prefetched files that get opened count as hits: hit_rate() tells
+    whether prefetching pays off.
+    """
+    policies = ('none', 'dir', 'ext', 'recent')
+
+    def __init__(self, policy, jobs, budget, metadata, batch, kernel,
+            remember=10000):
+        self.policy = policy
+        self.jobs = jobs
+        self.budget = budget
+        self.metadata = metadata
+        self.batch = batch
+        self.kernel = kernel
+        self.remember = remember
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.scans = deque()
+        self.queue = deque()
+        self.queued = {}
+        self.inflight = {}
+        self.prefetched = OrderedDict()
+        self.bytes = 0
+        self.stopped = False
+        self.threads = []
+        self.scheduled = 0
+        self.fetched = 0
+        self.fetched_bytes = 0
+        self.failed = 0
+        self.hits = 0
+
+    def start(self):
+        if self.policy == 'none' or self.threads:
+            return
+        for i in range(self.jobs):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def candidates(self, path):
+        """
+        returns the (path, size) of the files to fetch after path
+        """
+        dirname, basename = os.path.split(path)
+        res = []
+        for name in sorted(os.listdir(dirname)):
+            sibling = os.path.join(dirname, name)
+            if name == basename:
+                continue
+            if (self.policy == 'ext' and
+                    os.path.splitext(name)[1] != os.path.splitext(basename)[1]):
+                continue
+            try:
+                st, target, annexed, present = self.metadata.lookup(sibling)
+            except OSError:
+                continue
+            if annexed and not present:
+                size = key_size(os.path.basename(target)) or 0
+                res.append((name, sibling, size, st.st_mtime))
+        if self.policy == 'recent':
+            res.sort(key=lambda c: -c[3])
+        else:
+            # what comes after the opened file is more likely needed first
+            res = ([c for c in res if c[0] > basename] +
+                    [c for c in res if c[0] < basename])
+        return [(sibling, size) for name, sibling, size, mtime in res]
+
+    def missed(self, path):
+        """
+        open() had to fetch path: prefetch what should come next
+        """
+        if not self.threads:
+            return
+        with self.lock:
+            if path not in self.scans:
+                self.scans.append(path)
+                self.cond.notify()
+
+    def schedule(self, path):
+        """
+        queues the candidates after path, unless its directory is busy
+        """
+        dirname = os.path.dirname(path)
+        with self.lock:
+            for busy in self.queued.keys() + self.inflight.keys():
+                if os.path.dirname(busy) == dirname:
+                    return
+        candidates = self.candidates(path)
+        with self.lock:
+            for sibling, size in candidates:
+                if (sibling in self.queued or sibling in self.inflight or
+                        sibling in self.prefetched):
+                    continue
+                if self.bytes + size > self.budget:
+                    continue
+                self.queue.append(sibling)
+                self.queued[sibling] = size
+                self.bytes += size
+                self.scheduled += 1
+            self.cond.notify_all()
+
+    def claim(self, path):
+        """
+        open() needs path now: if it is being prefetched, wait for it and
+        return True. Otherwise make sure it won't be and return False.
+        """
+        with self.lock:
+            if path in self.queued:
+                self.queue.remove(path)
+                self.bytes -= self.queued.pop(path)
+                return False
+            event = self.inflight.get(path)
+        if event is None:
+            return False
+        event.wait()
+        with self.lock:
+            self.prefetched.pop(path, None)
+            self.hits += 1
+        return True
+
+    def opened(self, path):
+        """
+        open() found path present
+        """
+        if path in self.prefetched:
+            with self.lock:
+                if self.prefetched.pop(path, None) is not None:
+                    self.hits += 1
+
+    def hit_rate(self):
+        """
+        fraction of the prefetched files that were opened afterwards
+        """
+        if not self.fetched:
+            return 0.0
+        return float(self.hits) / self.fetched
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.scans and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                if self.scans:
+                    path, scan = self.scans.popleft(), True
+                else:
+                    path, scan = self.queue.popleft(), False
+                    size = self.queued.pop(path)
+                    event = self.inflight[path] = threading.Event()
+            if scan:
+                self.schedule(path)
+                continue
+            ok = self.batch.annex_get(path)
+            self.metadata.invalidate(path)
+            self.kernel.invalidate(path)
+            with self.lock:
+                del self.inflight[path]
+                self.bytes -= size
+                if ok:
+                    self.fetched += 1
+                    self.fetched_bytes += size
+                    self.prefetched[path] = True
+                    if len(self.prefetched) > self.remember:
+                        self.prefetched.popitem(last=False)
+                else:
+                    self.failed += 1
+            event.set()
+
+def read_ref(gitdir, ref):
+    """
+    returns the sha1 ref points to in the repository gitdir (its .git
+    directory, or a bare repository), without running git. None if it
+    can't be found.
+    """
+    try:
+        with open(os.path.join(gitdir, ref)) as f:
+            value = f.read().strip()
+        if not value.startswith('ref: '):
+            return value
+        return read_ref(gitdir, value[5:])
+    except IOError:
+        pass
+    try:
+        with open(os.path.join(gitdir, 'packed-refs')) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except IOError:
+        pass
+    return None
+
+class SyncScheduler:
+    """
+    Syncs with the remotes every interval seconds
+
+    A remote is only fetched and merged if its refs moved since we last
+    fetched it. For remotes that are local paths the refs are read
+    directly from their files, for the others 'git ls-remote' is used.
+    A remote that can't be reached is retried after an exponential,
+    jittered backoff (capped to maxbackoff seconds).
+    """
+    refs = ('refs/heads/master', 'refs/heads/git-annex')
+
+    def __init__(self, sharebox, interval, maxbackoff=3600):
+        self.sharebox = sharebox
+        self.interval = interval
+        self.maxbackoff = maxbackoff
+        self.last_seen = {}
+        self.failures = {}
+        self.next_attempt = {}
+        self.urls = {}
+        self.config_signature = None
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+        self.cycles = 0
+        self.skipped = 0
+
+    def start(self):
+        if self.interval > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            if not self.stopped:
+                self.cycle()
+
+    def remote_urls(self):
+        """
+        returns {remote: url}, read again when .git/config changes
+        """
+        signature = _stat_signature('.git/config')
+        if signature != self.config_signature:
+            output = subprocess.Popen(['git', 'config', '--get-regexp',
+                r'^remote\..*\.url$'], stdout=subprocess.PIPE).communicate()[0]
+            self.urls = {}
+            for line in output.splitlines():
+                key, url = line.split(' ', 1)
+                self.urls[key[len('remote.'):-len('.url')]] = url
+            self.config_signature = signature
+        return self.urls
+
+    def remote_refs(self, url):
+        """
+        returns the sha1s of self.refs on the remote at url, None if they
+        can't be read
+        """
+        path = url[len('file://'):] if url.startswith('file://') else url
+        if os.path.isdir(path):
+            gitdir = os.path.join(path, '.git')
+            if not os.path.isdir(gitdir):
+                gitdir = path
+            return tuple(read_ref(gitdir, ref) for ref in self.refs)
+        p = subprocess.Popen(['git', 'ls-remote', url] + list(self.refs),
+                stdout=subprocess.PIPE)
+        timer = threading.Timer(self.sharebox.synctimeout, terminate, [p])
+        timer.start()
+        output = p.communicate()[0]
+        timer.cancel()
+        if p.returncode:
+            return None
+        found = dict((ref, sha) for sha, ref in
+                (line.split() for line in output.splitlines()))
+        return tuple(found.get(ref) for ref in self.refs)
+
+    def failed(self, remote, now):
+        failures = self.failures[remote] = self.failures.get(remote, 0) + 1
+        delay = min(self.maxbackoff, self.interval * 2 ** failures)
+        self.next_attempt[remote] = now + delay * random.uniform(0.5, 1.5)
+
+    def cycle(self):
+        """
+        fetches and merges the remotes that changed
+        """
+        self.cycles += 1
+        now = time.time()
+        changed = {}
+        for remote, url in self.remote_urls().items():
+            if self.next_attempt.get(remote, 0) > now:
+                continue
+            refs = self.remote_refs(url)
+            if refs is None:
+                self.failed(remote, now)
+            elif refs != self.last_seen.get(remote):
+                changed[remote] = refs
+            else:
+                self.skipped += 1
+        if not changed:
+            return
+        self.sharebox.commits.flush()
+        fetched = self.sharebox.fetch(changed.keys())
+        for remote in changed:
+            if remote in fetched:
+                self.failures.pop(remote, None)
+                self.last_seen[remote] = changed[remote]
+                self.sharebox.merge(remote)
+            else:
+                self.failed(remote, now)
+        self.sharebox.kernel.drain()
+
+def split_stream(f, separator='\0'):
+    """
+    yields the fields of the file f, split by separator, as they are read
+    """
+    rest = ''
+    while True:
+        chunk = f.read(65536)
+        if not chunk:
+            break
+        fields = (rest + chunk).split(separator)
+        rest = fields.pop()
+        for field in fields:
+            yield field
+    if rest:
+        yield rest
+
+class History:
+    """
+    Index of the versions every path had, the newest last
+
+    A version is a [content, time] pair: content is the path of the
+    annexed object (.git/annex/objects/...) or the sha1 of the blob for
+    what isn't annexed, time the date of the commit that introduced it.
+
+    update() reads the commits made since the previous update and records
+    the versions they introduced, taking lock for each of them only: what
+    is indexed so far can be read meanwhile. refresh() does it in the
+    background. The index is saved in filename by save(), so that it
+    never reads the same commit twice, even across mounts.
+
+    If numversions > 0, only the numversions newest versions of each path
+    are kept. The annexed objects no path keeps anymore are queued in
+    unreferenced.
+
+    usage:
+
+    >>>  history = History(batch, numversions)
+    >>>  history.update()
+    >>>  with history.lock:
+    >>>    history.versions['./foo']
+    """
+    format = 2
+
+    def __init__(self, batch, numversions=0,
+            filename='.git/sharebox/history'):
+        self.batch = batch
+        self.numversions = numversions
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.updating = threading.Lock()
+        self.refreshing = False
+        self.commit = None
+        self.versions = {}
+        self.unreferenced = []
+        self.refs = {}
+        self.dirs = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+            if state['format'] != self.format:
+                raise ValueError('format %s' % state['format'])
+            self.commit = str(state['commit'])
+            self.versions = dict((str(path), [[str(content), t]
+                for content, t in versions])
+                for path, versions in state['versions'].items())
+            self.unreferenced = [str(obj) for obj in state['unreferenced']]
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            self.commit = None
+            self.versions = {}
+            self.unreferenced = []
+        self.refs = {}
+        self.dirs = {}
+        for path, versions in self.versions.items():
+            self.add_dirs(path)
+            for content, t in versions:
+                self.refs[content] = self.refs.get(content, 0) + 1
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            with open(self.filename + '.new', 'w') as f:
+                json.dump({'format': self.format, 'commit': self.commit,
+                    'versions': self.versions,
+                    'unreferenced': self.unreferenced}, f)
+            os.rename(self.filename + '.new', self.filename)
+            self.dirty = False
+
+    def add_dirs(self, path):
+        """
+        records path in the directories leading to it
+        """
+        while path != '.':
+            parent, name = os.path.split(path)
+            children = self.dirs.setdefault(parent, set())
+            if name in children:
+                break
+            children.add(name)
+            path = parent
+
+    def record(self, path, content, t):
+        """
+        path got content at the time t. Call with lock held.
+        """
+        versions = self.versions.get(path)
+        if versions is None:
+            versions = self.versions[path] = []
+            self.add_dirs(path)
+        for version in versions:
+            if version[0] == content:
+                versions.remove(version)
+                break
+        else:
+            self.refs[content] = self.refs.get(content, 0) + 1
+        versions.append([content, t])
+        while self.numversions > 0 and len(versions) > self.numversions:
+            old = versions.pop(0)[0]
+            self.refs[old] -= 1
+            if not self.refs[old]:
+                del self.refs[old]
+                if old.startswith('.git/annex/objects/'):
+                    self.unreferenced.append(old)
+
+    def update(self):
+        """
+        records the versions of the commits up to HEAD, returns whether
+        there were any
+        """
+        new = read_ref('.git', 'HEAD') or head()
+        if new is None or new == self.commit:
+            return False
+        with self.updating:
+            if new == self.commit:
+                return False
+            if self.commit is not None and not shell_do(['git', 'cat-file',
+                    '-e', self.commit]):
+                # history was rewritten: start over
+                with self.lock:
+                    self.commit = None
+                    self.versions = {}
+                    self.refs = {}
+                    self.dirs = {}
+            if self.commit is None:
+                revisions = [new]
+            else:
+                revisions = ['%s..%s' % (self.commit, new)]
+            p = subprocess.Popen(['git', 'log', '-z', '--reverse',
+                '--topo-order', '--raw', '--no-abbrev', '--no-renames',
+                '--format=commit %H %ct'] + revisions, stdout=subprocess.PIPE)
+            fields = split_stream(p.stdout)
+            t = 0
+            for field in fields:
+                field = field.lstrip('\n')
+                if field.startswith('commit '):
+                    t = int(field.split()[2])
+                if not field.startswith(':'):
+                    continue
+                srcmode, mode, srcblob, blob, status = field[1:].split()
+                path = './' + next(fields)
+                if status == 'D' or mode == '160000': # removed, submodule
+                    continue
+                content = blob
+                if mode == '120000':
+                    target = self.batch.cat(blob)
+                    if target and '.git/annex/objects/' in target:
+                        content = target[target.index('.git/annex/objects/'):]
+                with self.lock:
+                    self.record(path, content, t)
+            p.wait()
+            with self.lock:
+                self.commit = new
+                self.dirty = True
+            return True
+
+    def refresh(self):
+        """
+        update() in the background, unless HEAD was indexed already or an
+        update is running
+        """
+        with self.lock:
+            if self.refreshing or (self.commit is not None and
+                    read_ref('.git', 'HEAD') == self.commit):
+                return
+            self.refreshing = True
+        def run():
+            try:
+                self.update()
+            finally:
+                self.refreshing = False
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+class Pruner:
+    """
+    Drops in the background the versions of files beyond numversions
+
+    Every interval seconds, if the filesystem has been idle (idle()
+    tells), brings the History up to date and runs 'git annex drop' on
+    the annexed objects it doesn't reference anymore. git-annex refuses
+    to drop the content that doesn't have enough copies on the remotes
+    (numcopies): those are tried again at the next cycle. It drops a key
+    at most every pace seconds, and stops as soon as the filesystem is
+    used again.
+    """
+    def __init__(self, history, idle, interval=60, pace=1):
+        self.history = history
+        self.idle = idle
+        self.interval = interval
+        self.pace = pace
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        if self.history.numversions > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            if not self.stopped and self.idle():
+                self.cycle()
+
+    def cycle(self):
+        history = self.history
+        history.update()
+        with history.lock:
+            unreferenced = list(history.unreferenced)
+        for obj in unreferenced:
+            if self.stopped or not self.idle():
+                break
+            if obj not in history.refs: # not referenced again since
+                key = os.path.basename(obj)
+                if shell_do(['git', 'annex', 'drop', '--key=' + key]):
+                    self.dropped += 1
+                else:
+                    self.failed += 1
+                    continue
+            with history.lock:
+                history.unreferenced.remove(obj)
+                history.dirty = True
+            time.sleep(self.pace)
+        history.save()
+
+class Trash:
+    """
+    Read-only tree of the former versions of files, mounted on .trash
+
+    Every path that ever had content in history is a directory in there,
+    holding one file per version, named after the date of the commit
+    that introduced it. It is served from what the History indexed so
+    far, brought up to date in the background: annexed versions from
+    their objects (fetched if missing), the other ones through
+    'git cat-file --batch'. .trash itself always exists, empty until
+    there is a commit.
+
+    usage:
+
+    >>>  trash = Trash(history, batch)
+    >>>  trash('readdir', '/foo.txt', 0)
+    ['.', '..', '2012-03-04_100000.txt']
+    """
+    dir_mode = stat.S_IFDIR | 0555
+    file_mode = stat.S_IFREG | 0444
+
+    def __init__(self, history, batch):
+        self.history = history
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.contents = {} # handle -> content of the blobs opened
+
+    def __call__(self, op, path, *args):
+        """
+        path is relative to .trash: '/' for .trash itself
+        """
+        if op in ('getattr', 'readdir', 'open', 'read', 'readinto',
+                'release', 'access', 'readlink'):
+            self.history.refresh()
+            return getattr(self, op)('.' + path.rstrip('/'), *args)
+        if op in ('opendir', 'releasedir', 'flush', 'fsync', 'fsyncdir'):
+            return 0
+        raise FuseOSError(EROFS)
+
+    def version_names(self, path):
+        """
+        returns {name: (content, time)} for the versions of path
+        """
+        names = {}
+        versions = self.history.versions.get(path, ())
+        extension = os.path.splitext(path)[1]
+        for content, t in versions:
+            date = time.strftime('%Y-%m-%d_%H%M%S', time.localtime(t))
+            name = date + extension
+            i = 1
+            while name in names:
+                i += 1
+                name = '%s_%d%s' % (date, i, extension)
+            names[name] = (content, t)
+        return names
+
+    def lookup(self, path):
+        """
+        returns (content, time) for a version, None for a directory.
+        Raises ENOENT if there's no such thing in the trash.
+        """
+        with self.history.lock:
+            if (path == '.' or path in self.history.dirs or
+                    path in self.history.versions):
+                return None
+            parent, name = os.path.split(path)
+            version = self.version_names(parent).get(name)
+        if version is None:
+            raise FuseOSError(ENOENT)
+        return version
+
+    def getattr(self, path, fh=None):
+        version = self.lookup(path)
+        st = os.lstat('.')
+        res = dict((key, getattr(st, key)) for key in ('st_atime',
+            'st_ctime', 'st_gid', 'st_mtime', 'st_uid'))
+        if version is None:
+            res.update(st_mode=self.dir_mode, st_nlink=2, st_size=0)
+            return res
+        content, t = version
+        res.update(st_mode=self.file_mode, st_nlink=1, st_mtime=t,
+                st_ctime=t)
+        if content.startswith('.git/annex/objects/'):
+            try:
+                res['st_size'] = os.stat(content).st_size
+            except OSError:
+                res['st_size'] = 0
+        else:
+            res['st_size'] = self.batch.size(content) or 0
+        return res
+
+    def readdir(self, path, fh):
+        entries = [('.', None, 0), ('..', None, 0)]
+        with self.history.lock:
+            if (path != '.' and path not in self.history.dirs and
+                    path not in self.history.versions):
+                raise FuseOSError(ENOENT)
+            for name in sorted(self.history.dirs.get(path, ())):
+                entries.append((name, {'st_mode': self.dir_mode}, 0))
+            for name in sorted(self.version_names(path)):
+                entries.append((name, {'st_mode': self.file_mode}, 0))
+        return entries
+
+    def access(self, path, mode):
+        self.lookup(path)
+        if mode & os.W_OK:
+            raise FuseOSError(EROFS)
+
+    def readlink(self, path):
+        raise FuseOSError(EINVAL)
+
+    def open(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise FuseOSError(EROFS)
+        version = self.lookup(path)
+        if version is None:
+            raise FuseOSError(EISDIR)
+        content, t = version
+        if content.startswith('.git/annex/objects/'):
+            if not os.path.exists(content):
+                shell_do(['git', 'annex', 'get',
+                    '--key=' + os.path.basename(content)])
+            try:
+                return os.open(content, os.O_RDONLY)
+            except OSError:
+                raise FuseOSError(EACCES)
+        data = self.batch.cat(content)
+        if data is None:
+            raise FuseOSError(EACCES)
+        handle = next(virtual_handles)
+        with self.lock:
+            self.contents[handle] = data
+        return handle
+
+    def readinto(self, path, buf, size, offset, fh):
+        data = self.contents.get(fh)
+        if data is None:
+            res = pread(fh, buf, size, offset)
+        else:
+            data = data[offset:offset + size]
+            memmove(buf, data, len(data))
+            res = len(data)
+        stats.count('bytes read', res)
+        return res
+
+    def read(self, path, size, offset, fh):
+        buf = create_string_buffer(size)
+        res = self.readinto(path, buf, size, offset, fh)
+        return buf.raw[:res]
+
+    def release(self, path, fh):
+        with self.lock:
+            if self.contents.pop(fh, None) is None:
+                os.close(fh)
+
+class StatsFile:
+    """
+    The read-only file .stats: the stats of the filesystem, as lines of
+    'name value', plus the counters of the parts of sharebox.
+
+    Its content is rendered at most every second, and getattr and open
+    serve the same snapshot within that second, so that it matches the
+    size given. The kernel is told to forget that size right away: the
+    next lookup gets a new one.
+
+    usage:
+
+    >>>  statsfile = StatsFile(sharebox)
+    >>>  statsfile('getattr', '/.stats')
+    """
+    mode = stat.S_IFREG | 0444
+
+    def __init__(self, sharebox):
+        self.sharebox = sharebox
+        self.snapshot = ('', 0)
+        self.contents = {} # handle -> snapshot read through it
+
+    def __call__(self, op, path, *args):
+        if op in ('getattr', 'open', 'read', 'readinto', 'release',
+                'access'):
+            return getattr(self, op)(path, *args)
+        if op in ('flush', 'fsync'):
+            return 0
+        raise FuseOSError(EACCES)
+
+    def render(self):
+        sb = self.sharebox
+        lines = [stats.render()]
+        for name, value in (
+                ('metadata hits', sb.metadata.hits),
+                ('metadata misses', sb.metadata.misses),
+                ('metadata snapshot_hits', sb.metadata.snapshot_hits),
+                ('metadata entries', len(sb.metadata.entries)),
+                ('commits pending', len(sb.commits.pending)),
+                ('prefetch scheduled', sb.prefetcher.scheduled),
+                ('prefetch fetched', sb.prefetcher.fetched),
+                ('prefetch fetched_bytes', sb.prefetcher.fetched_bytes),
+                ('prefetch failed', sb.prefetcher.failed),
+                ('prefetch hit_rate', '%.3f' % sb.prefetcher.hit_rate()),
+                ('sync cycles', sb.scheduler.cycles),
+                ('sync skipped', sb.scheduler.skipped),
+                ('prune dropped', sb.pruner.dropped),
+                ('prune failed', sb.pruner.failed),
+                ('kernel invalidated', sb.kernel.invalidated)):
+            lines.append('%s %s\n' % (name, value))
+        return ''.join(lines)
+
+    def current(self):
+        content, t = self.snapshot
+        if time.time() - t > 1:
+            content = self.render()
+            self.snapshot = (content, time.time())
+        return content
+
+    def getattr(self, path, fh=None):
+        content = self.current()
+        self.sharebox.kernel.invalidate('.' + path)
+        now = time.time()
+        return {'st_mode': self.mode, 'st_nlink': 1, 'st_size': len(content),
+                'st_atime': now, 'st_mtime': now, 'st_ctime': now,
+                'st_uid': os.getuid(), 'st_gid': os.getgid()}
+
+    def access(self, path, mode):
+        if mode & os.W_OK:
+            raise FuseOSError(EACCES)
+
+    def open(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise FuseOSError(EACCES)
+        handle = next(virtual_handles)
+        self.contents[handle] = self.current()
+        return handle
+
+    def readinto(self, path, buf, size, offset, fh):
+        data = self.contents.get(fh, '')[offset:offset + size]
+        memmove(buf, data, len(data))
+        return len(data)
+
+    def read(self, path, size, offset, fh):
+        return self.contents.get(fh, '')[offset:offset + size]
+
+    def release(self, path, fh):
+        self.contents.pop(fh, None)
+
 class AnnexUnlock:
     """
     Annex unlock operation
@@ -96,82 +2659,216 @@ class AnnexUnlock:
     after.
 
     usage:
-    >>>  with AnnexUnlock(path):
+    >>>  with AnnexUnlock(path, metadata, commits):
     >>>    dosomething()
+
+    metadata is the MetadataCache to keep up to date, commits the
+    CommitQueue to record the change in. If empty, the file is unlocked
+    empty (see unlock).
     """
-    def __init__(self, path):
+    def __init__(self, path, metadata, commits, empty=False):
         self.path = path
-        self.annexed = annexed(path)
+        self.metadata = metadata
+        self.commits = commits
+        self.empty = empty
+        self.annexed = metadata.annexed(path)
 
     def __enter__(self):
         if self.annexed:
-            shell_do('git annex unlock "%s"' % self.path)
+            with self.commits.lock:
+                if not self.commits.unlocked(self.path):
+                    unlock(self.path, self.empty)
+            self.metadata.invalidate(self.path)
 
     def __exit__(self, type, value, traceback):
         if self.annexed:
-            shell_do('git annex add "%s"' % self.path)
-            shell_do('git commit -m "changed %s"' % self.path)
+            self.commits.add('changed %s' % self.path, self.path)
+        self.metadata.invalidate(self.path)
+
+class Download:
+    """
+    The content of an annexed file, while it is being fetched
+
+    get runs in a thread of its own and returns whether the content is
+    there once over. Meanwhile, readinto() serves what git-annex already
+    wrote in its temporary file (.git/annex/tmp/<key>), and waits for
+    the ranges that are not there yet. Remotes that transfer in order
+    (directories, rsync) give the first bytes right away; with the
+    others, the reads wait for the whole get.
+
+    usage:
+
+    >>>  download = Download(key, lambda: batch.annex_get(path))
+    >>>  download.readinto(buf, size, offset)
+    """
+    poll = 0.05
+
+    def __init__(self, key, get):
+        self.key = key
+        self.size = key_size(key)
+        self.tmp = os.path.join('.git', 'annex', 'tmp', key)
+        self.get = get
+        self.cond = threading.Condition()
+        self.done = False
+        self.ok = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        ok = False
+        try:
+            ok = self.get()
+        finally:
+            with self.cond:
+                self.done = True
+                self.ok = ok
+                self.cond.notify_all()
+
+    def wait(self):
+        """
+        waits for the end of the get, returns whether it succeeded
+        """
+        with self.cond:
+            while not self.done:
+                self.cond.wait()
+            return self.ok
+
+    def readinto(self, buf, size, offset):
+        """
+        pread() of the temporary file, once it covers the range. Returns
+        None when the get is over: the content is to be read instead.
+        """
+        end = offset + size
+        if self.size is not None:
+            end = min(end, self.size)
+        start = time.time()
+        while True:
+            with self.cond:
+                if self.done:
+                    if not self.ok:
+                        raise FuseOSError(EIO)
+                    return None
+            try:
+                fd = os.open(self.tmp, os.O_RDONLY)
+            except OSError:
+                fd = None # not started, or just moved to the objects
+            if fd is not None:
+                try:
+                    if os.fstat(fd).st_size >= end:
+                        stats.time('download wait', time.time() - start)
+                        return pread(fd, buf, size, offset)
+                finally:
+                    os.close(fd)
+            with self.cond:
+                if not self.done:
+                    self.cond.wait(self.poll)
+
+class Handle(object):
+    """
+    What is known about an open file, so that the operations on it don't
+    have to look at its path again
+
+    fd is the file descriptor given to fuse as the handle, copy the one
+    of the unlocked copy that replaces it once written (None until
+    then), annexed whether the file was an annexed link when opened.
+    dirty tells that the file was changed through the handle (written,
+    created or truncated by open) and has to be commited, offset
+    where fd (or copy) is positioned after the last write. download is
+    the Download read from while the content is fetched: fd is None
+    until it is over.
+
+    usage:
+
+    >>>  handle = Handle(os.open(path, flags), metadata.annexed(path))
+    >>>  os.fstat(handle.fileno())
+    """
+    __slots__ = ('fd', 'copy', 'annexed', 'dirty', 'offset', 'download')
+
+    def __init__(self, fd, annexed, dirty=False, download=None):
+        self.fd = fd
+        self.copy = None
+        self.annexed = annexed
+        self.dirty = dirty
+        self.offset = None
+        self.download = download
+
+    def fileno(self):
+        """
+        the file descriptor to read and write through
+        """
+        if self.copy is None:
+            return self.fd
+        return self.copy
 
 class CopyOnWrite:
     """
     Copy on Write operation
 
     Returns a suited file descriptor to use as a replacement for the one
-    you provide. Can clean and commit when your operation is over.
+    of the Handle you provide. Can clean and commit when your operation
+    is over.
 
     usage:
 
-    >>>  with CopyOnWrite(path, fh, opened_copies, unlock=False,
-    >>>         commit=False):
+    >>>  with CopyOnWrite(path, handle, metadata, commits,
+    >>>         unlock=False, commit=False):
     >>>    dosomething()
 
-    if opened_copies already contains a file descriptor opened for write
-    to use as a replacement for fh, return it
+    if the handle already has a copy opened for write, return it
 
-    >>>  with CopyOnWrite(path, fh, opened_copies, unlock=True,
-    >>>         commit=False):
+    >>>  with CopyOnWrite(path, handle, metadata, commits,
+    >>>         unlock=True, commit=False):
     >>>    dosomething()
 
-    same as above, except it will unlock a copy and create the file
-    descriptor if it was not found in opened_copies
+    same as above, except it will unlock a copy and open it if the handle
+    is on an annexed file without a copy yet
 
-    >>>  with CopyOnWrite(path, fh, opened_copies, unlock=True,
-    >>>         commit=True):
+    >>>  with CopyOnWrite(path, handle, metadata, commits,
+    >>>         unlock=True, commit=True):
     >>>    dosomething()
 
-    same as above, except after the operation the file descriptor in
-    opened_copies will be closed and deleted, and the copy will be
-    commited.
+    same as above, except after the operation the copy of the handle
+    will be closed, and the file commited (through the CommitQueue
+    commits).
+
+    metadata is the MetadataCache to keep up to date. If empty, the copy
+    is unlocked empty (see unlock).
     """
-    def __init__(self, path, fh, opened_copies, unlock, commit):
+    def __init__(self, path, handle, metadata, commits, unlock, commit,
+            empty=False):
         self.path = path
-        self.fh = fh
-        self.opened_copies = opened_copies
+        self.handle = handle
+        self.metadata = metadata
+        self.commits = commits
         self.unlock = unlock
         self.commit = commit
+        self.empty = empty
 
     def __enter__(self):
-        if self.unlock:
-            if self.opened_copies.get(self.fh, None) == None:
-                if annexed(self.path):
-                    shell_do('git annex unlock "%s"' % self.path)
-                    self.opened_copies[self.fh] = os.open(self.path,
-                            os.O_WRONLY | os.O_CREAT)
-        return self.opened_copies.get(self.fh, self.fh)
+        handle = self.handle
+        if self.unlock and handle.annexed and handle.copy is None:
+            with self.commits.lock:
+                # another writer may have unlocked it since open():
+                # its copy is the one to write to
+                if not self.commits.unlocked(self.path):
+                    unlock(self.path, self.empty)
+                self.metadata.invalidate(self.path)
+                handle.copy = os.open(self.path, os.O_RDWR | os.O_CREAT)
+                handle.offset = None
+                self.commits.writers[handle.fd] = self.path
+        return handle.fileno()
 
     def __exit__(self, type, value, traceback):
         if self.commit:
-            if self.opened_copies.get(self.fh, None) != None:
-                try:
-                    os.close(self.opened_copies[self.fh])
-                    del self.opened_copies[self.fh]
-                except KeyError:
-                    pass
+            if self.handle.copy is not None:
+                os.close(self.handle.copy)
+                self.handle.copy = None
             if not ignored(self.path):
-                shell_do('git annex add "%s"' % self.path)
-                shell_do('git commit -m "changed %s"' % self.path)
+                self.commits.add('changed %s' % self.path, self.path)
+            self.metadata.invalidate(self.path)
 
-class ShareBox(LoggingMixIn, Operations):
+class ShareBox(Operations):
     """
     Assumes operating from the root of the managed git directory
 
@@ -195,7 +2892,10 @@ class ShareBox(LoggingMixIn, Operations):
       launches a merge program if there are conflicts.
     """
     def __init__(self, gitdir, mountpoint, numversions,
-            getall, notifycmd):
+            getall, notifycmd, commitdelay=0, prefetch='none',
+            prefetchjobs=2, prefetchbudget=512 * 2**20, synctimeout=300,
+            syncinterval=0, getalljobs=4, getallorder='largest',
+            trace=None):
         """
         Calls 'git init' and 'git annex init' on the storage directory if
         necessary.
@@ -204,17 +2904,43 @@ class ShareBox(LoggingMixIn, Operations):
         self.mountpoint = mountpoint
         self.numversions = numversions
         self.getall = getall
+        self.getalljobs = getalljobs
+        self.getallorder = getallorder
+        self.getall_failed = set()
         self.notifycmd = notifycmd
-        self.rwlock = threading.Lock()
-        self.opened_copies = {}
-        with self.rwlock:
-            if os.path.realpath(os.curdir) != self.gitdir:
-                os.chdir(self.gitdir)
-            if not os.path.exists('.git'):
-                shell_do('git init')
-            if not os.path.exists('.git-annex'):
-                import socket
-                shell_do('git annex init "%s"' % socket.gethostname())
+        self.trace = trace
+        self.synctimeout = synctimeout
+        self.locks = LockManager()
+        self.handles = {} # fh -> Handle
+        self.downloads = {} # path -> Download
+        self.downloads_lock = threading.Lock()
+        self.metadata = MetadataCache()
+        self.batch = GitBatch(gitdir, prefetchjobs + getalljobs + 1)
+        self.kernel = KernelCache()
+        self.commits = CommitQueue(commitdelay, self.locks.git,
+                self.metadata, self.batch, self.kernel)
+        self.prefetcher = Prefetcher(prefetch, prefetchjobs, prefetchbudget,
+                self.metadata, self.batch, self.kernel)
+        self.scheduler = SyncScheduler(self, syncinterval)
+        if os.path.realpath(os.curdir) != self.gitdir:
+            os.chdir(self.gitdir)
+        if not os.path.exists('.git'):
+            shell_do('git init')
+        if not os.path.exists('.git-annex'):
+            import socket
+            shell_do('git annex init "%s"' % socket.gethostname())
+        if not os.path.isdir('.git/sharebox'):
+            os.mkdir('.git/sharebox')
+        self.metadata.snapshot = MetadataSnapshot()
+        self.unlock_method = unlock_method('.git/sharebox')
+        self.hashes = WriteHashes(annex_backend())
+        self.last_call = time.time()
+        self.history = History(self.batch, numversions)
+        self.pruner = Pruner(self.history,
+                lambda: time.time() - self.last_call > 10)
+        self.trash = Trash(self.history, self.batch)
+        self.statsfile = StatsFile(self)
+        log.write('info', msg='unlocking', method=self.unlock_method)
 
 
     def __call__(self, op, path, *args):
@@ -223,15 +2949,81 @@ class ShareBox(LoggingMixIn, Operations):
         """
         os.chdir(self.gitdir)   # when foreground is not set, the working
                                 # directory changes unexplainably
-        return super(ShareBox, self).__call__(op, "." + path, *args)
+        start = time.time()
+        ret = error = None
+        try:
+            if path == '/.trash' or path.startswith('/.trash/'):
+                ret = self.trash(op, path[len('/.trash'):] or '/', *args)
+            elif path == '/.stats':
+                ret = self.statsfile(op, path, *args)
+            else:
+                # reading .stats or .trash doesn't keep the pruner away
+                self.last_call = start
+                ret = super(ShareBox, self).__call__(op, "." + path, *args)
+            return ret
+        except EnvironmentError, e:
+            stats.count('op %s errors' % op)
+            error = e.errno
+            raise
+        except Exception, e:
+            log.write('error', op=op, path=path.decode('utf-8', 'replace'),
+                    args=summary(args), exception=repr(e))
+            raise
+        finally:
+            elapsed = time.time() - start
+            stats.time('op %s' % op, elapsed)
+            if log.sampled():
+                log.write('debug', op=op, path=path.decode('utf-8', 'replace'),
+                        args=summary(args), ret=summary(ret), errno=error,
+                        seconds=round(elapsed, 6))
+            if self.trace is not None:
+                self.trace.record(op, path, args, ret, error, start, elapsed)
+
+    def init(self, path):
+        """
+        Threads have to be started here: __init__ runs before fuse forks
+        to the background (and changes the working directory).
+        """
+        os.chdir(self.gitdir)
+        self.kernel.start()
+        self.commits.start()
+        self.prefetcher.start()
+        self.scheduler.start()
+        self.pruner.start()
+        # index the history in the background, before .trash is browsed
+        self.history.refresh()
+
+    def destroy(self, path):
+        """
+        Nothing pending must be lost when unmounting
+        """
+        self.scheduler.stop()
+        self.pruner.stop()
+        self.prefetcher.stop()
+        self.commits.stop()
+        self.commits.flush()
+        self.history.save()
+        # once the coprocesses exited: they may commit the git-annex branch
+        self.batch.stop()
+        self.metadata.save()
+        self.kernel.stop()
+        if self.trace is not None:
+            self.trace.output.flush()
 
     getxattr = None
     listxattr = None
     link = None                 # No hardlinks
     mknod = None                # No devices
-    mkdir = os.mkdir
-    readlink = os.readlink
-    rmdir = os.rmdir
+    def mkdir(self, path, mode):
+        os.mkdir(path, mode)
+        self.metadata.invalidate(path)
+
+    def readlink(self, path):
+        return self.metadata.readlink(path)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+        self.metadata.invalidate(path, recursive=True)
 
     def statfs(self, path):
         stv = os.statvfs(path)
@@ -240,22 +3032,53 @@ class ShareBox(LoggingMixIn, Operations):
             'f_files', 'f_flag', 'f_frsize', 'f_namemax'))
 
     def create(self, path, mode):
-        return os.open(path, os.O_WRONLY | os.O_CREAT, mode)
+        with self.commits.lock:
+            fh = os.open(path, os.O_WRONLY | os.O_CREAT, mode)
+            self.commits.writers[fh] = path
+        self.handles[fh] = Handle(fh, False, dirty=True)
+        self.metadata.invalidate(path)
+        return fh
 
     def utimens(self, path, times):
         if path == './.command':
             raise FuseOSError(EACCES)
         else:
             os.utime(path, times)
+            self.metadata.invalidate(path)
 
     def readdir(self, path, fh):
         """
         We have special files in the root to communicate with sharebox.
+
+        Entries come with their faked type, so that walks like find don't
+        need to getattr them. libfuse 2 ignores any other attribute here,
+        but looking them up fills the metadata cache for the getattr calls
+        of ls -l. Entries of the same mode share their attributes, which
+        fuse converts once.
         """
+        entries = [('.', None, 0), ('..', None, 0)]
         if path == './':
-            return ['.', '..', '.command'] + os.listdir(path)
-        else:
-            return ['.', '..'] + os.listdir(path)
+            entries.append(('.command', {'st_mode': 32896}, 0))
+            entries.append(('.trash', {'st_mode': Trash.dir_mode}, 0))
+            entries.append(('.stats', {'st_mode': StatsFile.mode}, 0))
+        prefix = path.rstrip('/') + '/'
+        modes = {}
+        for name in os.listdir(path):
+            try:
+                st, target, annexed, present = self.metadata.lookup(
+                        prefix + name)
+            except OSError:
+                entries.append((name, None, 0)) # removed in the meantime
+                continue
+            if annexed:
+                mode = 33188 # as in getattr
+            else:
+                mode = st.st_mode
+            attrs = modes.get(mode)
+            if attrs is None:
+                attrs = modes[mode] = {'st_mode': mode}
+            entries.append((name, attrs, 0))
+        return entries
 
     def access(self, path, mode):
         """
@@ -266,8 +3089,9 @@ class ShareBox(LoggingMixIn, Operations):
             if mode & os.R_OK:
                 raise FuseOSError(EACCES)
         else:
-            if annexed(path):
-                if not os.path.exists(path):
+            st, target, annexed, present = self.metadata.lookup(path)
+            if annexed:
+                if not present:
                     raise FuseOSError(EACCES)
             else:
                 if not os.access(path, mode):
@@ -276,29 +3100,100 @@ class ShareBox(LoggingMixIn, Operations):
     def open(self, path, flags):
         """
         When an annexed file is requested, if it is not present on the
-        system we first try to get it. If it fails, we refuse the access.
-        Since we do copy on write, we do not need to try to open in write
-        mode annexed files.
+        system we first try to get it. Read only, the handle is given
+        right away and reads what is downloaded so far (see Download);
+        they fail if the get does. Otherwise we wait for the get and
+        refuse the access if it fails. Since we do copy on write, we do
+        not need to try to open in write mode annexed files. Unless they
+        are truncated (O_TRUNC, see atomic_o_trunc): their content is
+        neither fetched nor copied then, and the truncation is commited
+        with what is written.
         """
         if path == './.command':
-            return os.open('/dev/null', flags)
+            res = os.open('/dev/null', flags)
+            self.handles[res] = Handle(res, False)
+            return res
         else:
             res = None
-            if annexed(path):
-                if not os.path.exists(path):
-                    shell_do('git annex get "%s"' % path)
+            st, target, annexed, present = self.metadata.lookup(path)
+            writing = flags & (os.O_WRONLY | os.O_RDWR)
+            if writing and flags & os.O_TRUNC:
+                self.hashes.broken(path)
+            if annexed and writing and flags & os.O_TRUNC:
+                with self.commits.lock:
+                    # unlocked by another writer since the lookup: the
+                    # copy it writes to is truncated in place by O_TRUNC
+                    if not self.commits.unlocked(path):
+                        unlock(path, empty=True)
+                    res = os.open(path, flags)
+                    self.commits.writers[res] = path
+                self.metadata.invalidate(path)
+                self.handles[res] = Handle(res, False, dirty=True)
+                return res
+            elif annexed:
+                if present:
+                    self.prefetcher.opened(path)
+                elif not writing:
+                    self.prefetcher.missed(path)
+                    res = next(virtual_handles)
+                    self.handles[res] = Handle(None, annexed,
+                            download=self.download(path, target))
+                    return res
+                else:
+                    self.prefetcher.missed(path)
+                    self.download(path, target).wait()
                 if not os.path.exists(path):
                     raise FuseOSError(EACCES)
                 res = os.open(path, os.R_OK) # magic to open read only
+            elif writing:
+                # not while a commit may be annexing it
+                with self.commits.lock:
+                    res = os.open(path, flags)
+                    self.commits.writers[res] = path
+                self.handles[res] = Handle(res, False,
+                        dirty=bool(flags & os.O_TRUNC))
+                return res
             else:
                 res = os.open(path, flags)
+            self.handles[res] = Handle(res, annexed)
             return res
 
+    def download(self, path, target):
+        """
+        returns the Download of the content of path, started unless it
+        already is
+        """
+        with self.downloads_lock:
+            download = self.downloads.get(path)
+            if download is None:
+                def get():
+                    try:
+                        if not self.prefetcher.claim(path):
+                            self.batch.annex_get(path)
+                        self.metadata.invalidate(path)
+                        self.kernel.invalidate(path)
+                        return os.path.exists(path)
+                    finally:
+                        with self.downloads_lock:
+                            del self.downloads[path]
+                download = Download(os.path.basename(target), get)
+                self.downloads[path] = download
+            return download
+
+    def handle(self, fh):
+        """
+        returns the Handle of fh
+        """
+        try:
+            return self.handles[fh]
+        except KeyError:
+            raise FuseOSError(EBADF)
+
     def getattr(self, path, fh=None):
         """
         When an annexed file is requested, we fake some of its attributes,
-        making it look like a conventional file (of size 0 if if is not
-        present on the system).
+        making it look like a conventional file (of the size its key
+        tells if it is not present on the system, 0 if it does not).
 
         FIXME: this method has too much black magic. We should find a way
         to show annexed files as regular and writable by altering the
@@ -314,19 +3209,17 @@ class ShareBox(LoggingMixIn, Operations):
                     'st_gid': 1000, 'st_uid': 1000, 'st_atime':
                     time.time()}
         else:
-            path_ = path
             faked_attr = {}
-            if annexed(path):
+            st, target, annexed, present = self.metadata.lookup(path)
+            if annexed:
                 faked_attr ['st_mode'] = 33188 # we fake a 644 regular file
-                if os.path.exists(path):
-                    base = os.path.dirname(path_)
-                    path_ = os.path.join(base, os.readlink(path))
-                else:
-                    faked_attr ['st_size'] = 0
-            st = os.lstat(path_)
-            res = dict((key, getattr(st, key)) for key in ('st_atime',
-                'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
-                'st_nlink', 'st_size', 'st_uid'))
+                if not present:
+                    faked_attr ['st_size'] = key_size(
+                            os.path.basename(target)) or 0
+            res = {'st_atime': st.st_atime, 'st_ctime': st.st_ctime,
+                    'st_gid': st.st_gid, 'st_mode': st.st_mode,
+                    'st_mtime': st.st_mtime, 'st_nlink': st.st_nlink,
+                    'st_size': st.st_size, 'st_uid': st.st_uid}
             for attr, value in faked_attr.items():
                 res [attr] = value
             return res
@@ -335,116 +3228,193 @@ class ShareBox(LoggingMixIn, Operations):
         if path == './.command':
             raise FuseOSError(EACCES)
         else:
-            with self.rwlock:
-                with AnnexUnlock(path):
+            with self.locks.write(path):
+                with AnnexUnlock(path, self.metadata, self.commits):
                     os.chmod(path, mode)
 
     def chown(self, path, user, group):
         if path == './.command':
             raise FuseOSError(EACCES)
         else:
-            with self.rwlock:
-                with AnnexUnlock(path):
+            with self.locks.write(path):
+                with AnnexUnlock(path, self.metadata, self.commits):
                     os.chown(path, user, group)
 
     def truncate(self, path, length, fh=None):
+        """
+        Through a handle (ftruncate), its copy is truncated and commited
+        when it is released. Otherwise the file is commited right away.
+        An annexed file truncated to 0 is not copied first.
+        """
         if path == './.command':
             return
+        elif fh is not None:
+            handle = self.handle(fh)
+            with self.locks.write(path):
+                with CopyOnWrite(path, handle, self.metadata, self.commits,
+                        unlock=True, commit=False,
+                        empty=(length == 0)) as fh_:
+                    os.ftruncate(fh_, length)
+                    handle.dirty = True
+                    self.hashes.broken(path)
+                    self.metadata.invalidate(path)
         else:
-            with self.rwlock:
-                with AnnexUnlock(path):
-                    with open(path, 'r+') as f:
-                        f.truncate(length)
+            with self.locks.write(path):
+                with AnnexUnlock(path, self.metadata, self.commits,
+                        empty=(length == 0)):
+                    fd = os.open(path, os.O_WRONLY)
+                    try:
+                        os.ftruncate(fd, length)
+                    finally:
+                        os.close(fd)
+                    self.hashes.broken(path)
 
     def flush(self, path, fh):
         if path == './.command':
             return
         else:
-            with self.rwlock:
-                with CopyOnWrite(path, fh, self.opened_copies,
-                        unlock=False, commit=False) as fh_:
-                    os.fsync(fh_)
+            with self.locks.read(path):
+                fd = self.handle(fh).fileno()
+                if fd is not None: # nothing to sync while downloading
+                    os.fsync(fd)
 
     def fsync(self, path, datasync, fh):
         if path == './.command':
             return
         else:
-            with self.rwlock:
-                with CopyOnWrite(path, fh, self.opened_copies,
-                        unlock=False, commit=False) as fh_:
-                    os.fsync(fh_)
+            with self.locks.read(path):
+                fd = self.handle(fh).fileno()
+                if fd is not None:
+                    os.fsync(fd)
 
     def read(self, path, size, offset, fh):
+        buf = create_string_buffer(size)
+        res = self.readinto(path, buf, size, offset, fh)
+        return buf.raw[:res]
+
+    def readinto(self, path, buf, size, offset, fh):
+        """
+        pread() straight into the buffer of fuse. Unlike lseek() and
+        read(), it does not move the offset shared by concurrent readers.
+
+        No lock is taken, so that readers don't contend with each other:
+        the file descriptors of a handle are its own, only a write
+        through the handle adds one (the copy), and they stay open until
+        release.
+        """
         if path == './.command':
-            return
+            return 0
         else:
-            with self.rwlock:
-                with CopyOnWrite(path, fh, self.opened_copies,
-                        unlock=False, commit=False) as fh_:
-                    os.lseek(fh_, offset, 0)
-                    return os.read(fh_, size)
+            handle = self.handle(fh)
+            download = handle.download
+            if download is not None:
+                res = self.stream(path, handle, download, buf, size, offset)
+            else:
+                res = pread(handle.fileno(), buf, size, offset)
+            stats.count('bytes read', res)
+            return res
+
+    def stream(self, path, handle, download, buf, size, offset):
+        """
+        reads through a handle opened while its content was missing: from
+        the download, then from the content once it is over
+        """
+        res = download.readinto(buf, size, offset)
+        if res is not None:
+            stats.count('bytes streamed', res)
+            return res
+        fd = os.open(path, os.O_RDONLY)
+        with download.cond:
+            if handle.fd is None:
+                handle.fd, fd = fd, None
+                handle.download = None
+        if fd is not None:
+            os.close(fd)
+        return pread(handle.fd, buf, size, offset)
+
+    write_memoryview = True
+    atomic_o_trunc = True
 
     def write(self, path, data, offset, fh):
         if path == './.command':
-            self.dotcommand(data)
+            self.dotcommand(data.tobytes())
             return len(data)
         else:
-            with self.rwlock:
-                with CopyOnWrite(path, fh, self.opened_copies,
+            handle = self.handle(fh)
+            with self.locks.write(path):
+                with CopyOnWrite(path, handle, self.metadata, self.commits,
                         unlock=True, commit=False) as fh_:
-                    os.lseek(fh_, offset, 0)
-                    return os.write(fh_, data)
+                    # sequential writes need no seek
+                    if handle.offset != offset:
+                        os.lseek(fh_, offset, 0)
+                    res = os.write(fh_, data)
+                    handle.offset = offset + res
+                    handle.dirty = True
+                    stats.count('bytes written', res)
+                    self.hashes.written(path, fh, offset, data[:res])
+                    self.metadata.invalidate(path)
+                    return res
 
     def release(self, path, fh):
         """
-        Closed files are commited and removed from the open fd list
+        Closed files are commited and removed from the open fd list. The
+        ones that were not changed through fh are only closed.
         """
-        with self.rwlock:
-            with CopyOnWrite(path, fh, self.opened_copies,
+        handle = self.handle(fh)
+        del self.handles[fh]
+        if not handle.dirty:
+            if fh in self.commits.writers:
+                self.commits.closed(fh)
+            if handle.fd is not None:
+                os.close(handle.fd)
+            stats.count('commits avoided')
+            return
+        with self.locks.write(path):
+            with CopyOnWrite(path, handle, self.metadata, self.commits,
                     unlock=False, commit=True):
+                self.commits.closed(fh, changed=True)
                 os.close(fh)
+                key = self.hashes.key(path, fh)
+                if key is not None:
+                    self.commits.hashed(path, key)
 
     def rename(self, old, new):
         if old == './.command' or new == '/.command':
             raise FuseOSError(EACCES)
+        elif new == '/.trash' or new.startswith('/.trash/'):
+            raise FuseOSError(EROFS)
         else:
-            with self.rwlock:
-                # Make sure to lock the file (and to annex it if it was not)
-                if not ignored(old):
-                    shell_do('git annex add "%s"' % old)
+            with self.locks.write(old, '.' + new):
                 os.rename(old, '.' + new)
-                if ignored(old) or ignored('.' + new):
-                    if not ignored(old):
-                        shell_do('git rm "%s"' % old)
-                        shell_do('git commit -m "moved %s to ignored file"' % old)
-                    if not ignored('.' + new):
-                        shell_do('git annex add ".%s"' % new)
-                        shell_do('git commit -m "moved an ignored file to .%s"' % new)
-                else:
-                    shell_do('git mv "%s" ".%s"' % (old, new))
-                    shell_do('git commit -m "moved %s to .%s"' % (old, new))
+                self.hashes.broken(old)
+                self.hashes.broken('.' + new)
+                fix_annex_link(old, '.' + new)
+                self.metadata.invalidate(old, recursive=True)
+                self.metadata.invalidate('.' + new, recursive=True)
+                # the old path leaves the index, the new one enters it
+                # unless it is ignored
+                self.commits.add('moved %s to .%s' % (old, new), old,
+                        '.' + new)
 
 
     def symlink(self, target, source):
         if target == './.command':
             raise FuseOSError(EACCES)
         else:
-            with self.rwlock:
+            with self.locks.write(target):
                 os.symlink(source, target)
-                if not ignored(target):
-                    shell_do('git annex add "%s"' % target)
-                    shell_do('git commit -m "created symlink %s -> %s"' %(target,
-                        source) )
+                self.metadata.invalidate(target)
+                self.commits.add('created symlink %s -> %s' % (target,
+                    source), target)
 
     def unlink(self, path):
         if path == './.command':
             raise FuseOSError(EACCES)
         else:
-            with self.rwlock:
+            with self.locks.write(path):
                 os.unlink(path)
-                if not ignored(path):
-                    shell_do('git rm "%s"' % path)
-                    shell_do('git commit -m "removed %s"' % path)
+                self.metadata.invalidate(path)
+                self.commits.add('removed %s' % path, path)
 
     def dotcommand(self, text):
         for command in text.strip().split('\n'):
@@ -454,31 +3424,80 @@ class ShareBox(LoggingMixIn, Operations):
                 self.sync(True)
             if command.startswith('get '):
                 shell_do('git annex ' + command)
+                self.metadata.clear()
+                self.kernel.invalidate_all()
+                self.kernel.drain()
+
+    def fetch(self, remotes):
+        """
+        Fetches the remotes in parallel, each within synctimeout seconds,
+        and returns the ones that could be fetched. No lock is needed:
+        fetching only writes objects and remote tracking refs.
+        """
+        fetched = {}
+        def fetch_one(remote):
+            start = time.time()
+            fetched[remote] = shell_do(['git', 'fetch', '-q', remote],
+                    timeout=self.synctimeout)
+            stats.set('sync %s fetch' % remote, '%.6f' % (time.time() - start))
+        threads = [threading.Thread(target=fetch_one, args=(remote,))
+                for remote in remotes]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return [remote for remote in remotes if fetched.get(remote)]
+
+    def merge(self, remote, manual_merge=False):
+        """
+        Merges what was fetched from remote. Only this excludes the other
+        operations, since it rewrites the working tree.
+        """
+        start = time.time()
+        with self.locks.exclusive():
+            with self.locks.git:
+                before = head()
+                merged = shell_do(['git', 'merge', '-q', '%s/master' % remote])
+                if merged:
+                    shell_do('git commit -m "merged with %s"' % remote)
+                    changed = ['./' + p for p in changed_paths(before, head())]
+                    for path in changed:
+                        self.metadata.invalidate(path)
+                    # their directories got or lost entries too
+                    self.kernel.invalidate(*changed +
+                            [parent(path) for path in changed])
+                else:
+                    names = os.listdir('.')
+                    shell_do('git reset --hard')
+                    shell_do('git clean -f')
+                    self.metadata.clear()
+                    self.kernel.invalidate_all(names)
+        stats.set('sync %s merge' % remote, '%.6f' % (time.time() - start))
+        if not merged:
+            if manual_merge:
+                shell_do(self.notifycmd %
+                        "Manual merge invoked, but not implemented.")
+            else:
+                shell_do(self.notifycmd %
+                        "Manual merge is required. Run: \nsharebox --merge "+
+                        self.mountpoint)
+        elif self.getall:
+            # only what the merge changed, plus what failed last time
+            paths = self.getall_failed.union(changed)
+            self.getall_failed = set(get_missing(paths, self.metadata,
+                self.batch, self.getalljobs, self.getallorder))
+            self.kernel.invalidate(*paths)
+        return merged
 
     def sync(self, manual_merge=False):
-        with sharebox.rwlock:
-            shell_do('git fetch --all')
-            repos = subprocess.Popen(
-                    shlex.split('git remote show'),
-                    stdout=subprocess.PIPE).communicate()[0].strip().split('\n')
-            for remote in repos:
-                if remote:
-                    if not shell_do('git merge %s/master' % remote):
-                        if manual_merge:
-                            shell_do(self.notifycmd %
-                                    "Manual merge invoked, but not implemented.")
-                            shell_do('git reset --hard')
-                            shell_do('git clean -f')
-                        else:
-                            shell_do('git reset --hard')
-                            shell_do('git clean -f')
-                            shell_do(self.notifycmd %
-                                    "Manual merge is required. Run: \nsharebox --merge "+
-                                    self.mountpoint)
-                    else:
-                        if self.getall:
-                            shell_do('git annex get .')
-                        shell_do('git commit -m "merged with %s"' % remote)
+        """
+        Fetches all the remotes, then merges them one by one.
+        """
+        self.commits.flush()
+        for remote in self.fetch(remotes()):
+            self.merge(remote, manual_merge)
+        # what the merges changed is not shown stale once sync returns
+        self.kernel.drain()
 
 def send_sharebox_command(command, mountpoint):
     """
@@ -509,7 +3528,20 @@ if __name__ == "__main__":
     command = None
     gitdir = None
     getall = False
+    getalljobs = 4
+    getallorder = 'largest'
     numversions = 0
+    commitdelay = 0
+    prefetch = 'none'
+    prefetchjobs = 2
+    prefetchbudget = 512
+    synctimeout = 300
+    syncinterval = 0
+    cachetimeout = 60
+    loglevel = None
+    logsample = 1
+    logfile = None
+    tracefile = None
     notifycmd = 'notify-send "sharebox" "%s"'
 
     for opt, arg in opts:
@@ -526,8 +3558,43 @@ if __name__ == "__main__":
                     gitdir = value
                 elif option == 'numversions':
                     numversions = int(value)
+                elif option == 'getalljobs':
+                    getalljobs = int(value)
+                elif option == 'getallorder':
+                    if value not in getall_orders:
+                        print("unrecognized getall order: %s" % value)
+                        sys.exit(1)
+                    getallorder = value
                 elif option == 'notifycmd':
                     notifycmd = value
+                elif option == 'commitdelay':
+                    commitdelay = float(value)
+                elif option == 'prefetch':
+                    if value not in Prefetcher.policies:
+                        print("unrecognized prefetch policy: %s" % value)
+                        sys.exit(1)
+                    prefetch = value
+                elif option == 'prefetchjobs':
+                    prefetchjobs = int(value)
+                elif option == 'prefetchbudget':
+                    prefetchbudget = int(value)
+                elif option == 'synctimeout':
+                    synctimeout = float(value)
+                elif option == 'sync':
+                    syncinterval = float(value)
+                elif option == 'cachetimeout':
+                    cachetimeout = float(value)
+                elif option == 'loglevel':
+                    if value not in Log.levels:
+                        print("unrecognized log level: %s" % value)
+                        sys.exit(1)
+                    loglevel = value
+                elif option == 'logsample':
+                    logsample = int(value)
+                elif option == 'logfile':
+                    logfile = value
+                elif option == 'trace':
+                    tracefile = value
                 else:
                     print("unrecognized option: %s" % option)
                     sys.exit(1)
@@ -556,6 +3623,23 @@ if __name__ == "__main__":
             sys.exit(1)
         gitdir = os.path.realpath(gitdir)
 
+        if loglevel is None:
+            loglevel = 'debug' if foreground else 'warning'
+        if logfile:
+            log.configure(loglevel, logsample, open(logfile, 'a'))
+        else:
+            log.configure(loglevel, logsample, sys.stdout)
+
         sharebox = ShareBox(gitdir, mountpoint, numversions, getall,
-                notifycmd)
-        fuse = FUSE(sharebox, mountpoint, foreground=foreground)
+                notifycmd, commitdelay, prefetch, prefetchjobs,
+                prefetchbudget * 2**20, synctimeout, syncinterval,
+                getalljobs, getallorder,
+                Trace(open(tracefile, 'a')) if tracefile else None)
+        if notify_supported:
+            # auto_cache keeps the data of a file in the kernel until its
+            # size or mtime change. Strings: fuse passes True as a flag.
+            cache = {'attr_timeout': str(cachetimeout),
+                    'entry_timeout': str(cachetimeout), 'auto_cache': True}
+        else:
+            cache = {}  # nothing would make the kernel forget
+        fuse = FUSE(sharebox, mountpoint, foreground=foreground, **cache)
@@ -56,6 +56,22 @@ test_must_fail(){
     ($@ 2>&1) >/dev/null && echo "Error: This succeeded: $@"
 }
 
+# the root of the mount shows the attributes of the git directory
+same_root_attributes(){
+    test "$(stat -c '%h %Y' test/$1/mnt)" = "$(stat -c '%h %Y' test/$1/git)"
+}
+
+# files are commited once released, after close returned: wait_commit
+# waits (10 seconds at most) until the file $2 of $1 is
+wait_commit(){
+    i=0
+    while test $i -lt 100 && test -z "$(cd test/$1/git &&
+            git log --oneline -- $2 2>/dev/null)"; do
+        sleep 0.1
+        i=$((i + 1))
+    done
+}
+
 #-----------------------------------------------------------------------#
 # tests
 #-----------------------------------------------------------------------#
@@ -69,6 +85,23 @@ mount_unmount(){
     clean
 }
 
+root_attributes(){
+    echo "attributes of the root after changes"
+    init local
+    mount local
+    test_must_success same_root_attributes local
+    sleep 1
+    mkdir test/local/mnt/newdir
+    test_must_success same_root_attributes local
+    sleep 1
+    echo "test_line" > test/local/mnt/test_file
+    wait_commit local test_file
+    test_must_success same_root_attributes local
+    debug_interrupt
+    unmount local
+    clean
+}
+
 sync_simple(){
     echo "simple synchronization"
     init local
@@ -80,10 +113,10 @@ sync_simple(){
     ./sharebox.py -c sync test/remote/mnt
     # after sync, the file must exist
     test_must_success test -e test/remote/mnt/test_file
-    # but diffing should fail because it is recorded as size 0
-    test_must_fail diff test/local/mnt/test_file test/remote/mnt/test_file
-    # diffing should work the second time (opened by the first diff, so it
-    # has been downloaded)
+    # diffing should work the first time: the file shows the size of its
+    # key, and opening it streams the content while it is downloaded
+    test_must_success diff test/local/mnt/test_file test/remote/mnt/test_file
+    # and the second time, from the downloaded content
     test_must_success diff test/local/mnt/test_file test/remote/mnt/test_file
     debug_interrupt
     unmount local
@@ -113,6 +146,23 @@ sync_normal_conflict(){
     clean
 }
 
+sync_auto(){
+    echo "automatic synchronization"
+    init local
+    init remote
+    mount local
+    mount_autosync remote
+    make_peers local remote
+    echo "test_line" >> test/local/mnt/test_file
+    # the remote is mounted with a 1 second sync interval
+    sleep 3
+    test_must_success test -e test/remote/mnt/test_file
+    debug_interrupt
+    unmount local
+    unmount remote
+    clean
+}
+
 sync_delete_conflict(){
     echo "synchronization with delete conflict"
     init local
@@ -136,6 +186,8 @@ sync_delete_conflict(){
 }
 
 mount_unmount
+root_attributes
 sync_simple
 sync_normal_conflict
 sync_delete_conflict
+sync_auto